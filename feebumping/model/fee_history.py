@@ -0,0 +1,310 @@
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from pandas import read_csv
+
+THIRTY_DAYS = 144 * 30
+NINETY_DAYS = 144 * 90
+
+# The rolling statistics over the mean feerate each strategy is computed from, as
+# (window, min_periods, statistic, quantile, cumulative max).
+FALLBACK_EST_STRATS = {
+    "MA30": (THIRTY_DAYS, 144, "mean", None, False),
+    "ME30": (THIRTY_DAYS, 144, "median", None, False),
+    "85Q1H": (6, 1, "quantile", 0.85, False),
+}
+RESERVE_STRATS = {
+    "95Q30": (THIRTY_DAYS, 144, "quantile", 0.95, False),
+    "95Q90": (NINETY_DAYS, 144, "quantile", 0.95, False),
+    "CUMMAX95Q90": (NINETY_DAYS, 144, "quantile", 0.95, True),
+    "CUMMAX95Q1": (144, 14, "quantile", 0.95, True),
+}
+# The statistics used by the CF coin selection, whatever the strategies.
+ME90 = (NINETY_DAYS, 144, "median", None, False)
+Q20_90 = (NINETY_DAYS, 144, "quantile", 0.2, False)
+
+# The series a FeeHistory is made of.
+COLUMNS = [
+    "mean_feerate",
+    "est_1block",
+    "min_feerate",
+    "reserve_feerate",
+    "fallback_feerate",
+    "me90",
+    "q20_90",
+]
+
+# Bump it whenever the way the series are computed changes, to invalidate the cache.
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fee_cache"
+)
+
+
+def as_float_array(series, nan_sentinel=np.nan):
+    """Convert a historical data column to a contiguous float64 array.
+
+    The "NaN" strings that may be present in the column are replaced once and for
+    all by {nan_sentinel}.
+    """
+    if series.dtype == object:
+        series = series.replace("NaN", nan_sentinel)
+    return np.ascontiguousarray(series.to_numpy(dtype=np.float64))
+
+
+def rolling_stat(series, params):
+    """Compute a rolling statistic over {series} as described by {params}."""
+    window, min_periods, stat, quantile, cummax = params
+    rolling = series.rolling(window, min_periods=min_periods)
+    if stat == "mean":
+        res = rolling.mean()
+    elif stat == "median":
+        res = rolling.median()
+    elif stat == "quantile":
+        res = rolling.quantile(quantile=quantile, interpolation="linear")
+    else:
+        raise ValueError(f"Unknown rolling statistic '{stat}'")
+    return res.cummax() if cummax else res
+
+
+def check_strats(reserve_strat, fallback_est_strat):
+    if fallback_est_strat not in FALLBACK_EST_STRATS:
+        raise ValueError("Estimate strategy not implemented")
+    if reserve_strat not in RESERVE_STRATS:
+        raise ValueError("Reserve strategy not implemented")
+
+
+def file_hash(path):
+    """The SHA256 of the content of the file at {path}, as an hex string."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(csv_hash, reserve_strat, fallback_est_strat):
+    """The name of the cache entry for this fee history and these strategies.
+
+    It commits to the parameters of the rolling statistics, so changing them
+    invalidates the entry.
+    """
+    h = hashlib.sha256()
+    h.update(
+        repr(
+            (
+                CACHE_VERSION,
+                csv_hash,
+                reserve_strat,
+                RESERVE_STRATS[reserve_strat],
+                fallback_est_strat,
+                FALLBACK_EST_STRATS[fallback_est_strat],
+                ME90,
+                Q20_90,
+            )
+        ).encode()
+    )
+    return f"{reserve_strat}-{fallback_est_strat}-{h.hexdigest()[:32]}"
+
+
+class FirstBelowIndex:
+    """An index over a series of values by height, to find the first height from
+    a given one at which the value is below some threshold in logarithmic time.
+
+    It is a segment tree of the minimum value over ranges of heights. NaN values
+    are never below any threshold.
+    """
+
+    def __init__(self, start_height, series):
+        self.start_height = start_height
+        self.size = 1 << max(len(series) - 1, 1).bit_length()
+        # The node i covers the children 2i and 2i+1, the leaves start at {size}.
+        tree = np.full(2 * self.size, np.inf)
+        tree[self.size : self.size + len(series)] = np.where(
+            np.isnan(series), np.inf, series
+        )
+        level = self.size
+        while level > 1:
+            tree[level // 2 : level] = np.minimum(
+                tree[level : 2 * level : 2], tree[level + 1 : 2 * level : 2]
+            )
+            level //= 2
+        self.tree = tree
+
+    def first_below(self, threshold, height):
+        """The first height from {height} at which the value is strictly below
+        {threshold}, None if there is none."""
+        tree = self.tree
+        i = self.size + max(height - self.start_height, 0)
+        if i >= 2 * self.size:
+            return None
+        while tree[i] >= threshold:
+            # Move to the node covering the range right after this one
+            while i & 1:
+                i >>= 1
+            if i == 0:
+                return None
+            i += 1
+        # Then go down to the first leaf below the threshold
+        while i < self.size:
+            i *= 2
+            if tree[i] >= threshold:
+                i += 1
+        return self.start_height + i - self.size
+
+
+class FeeHistory:
+    """The historical feerate series the WT bases its estimates on.
+
+    All the series are stored as contiguous float64 arrays, offset by the height
+    of the first block in the history. Looking up a value at a given height is
+    therefore plain array indexing rather than a pandas Series lookup.
+    """
+
+    def __init__(self, start_height, columns):
+        self.start_height = start_height
+        # The mean feerate in each block, the rolling stats are computed from it.
+        self.mean_feerate = columns["mean_feerate"]
+        # Value of estimatesmartfee, NaN if no estimate was available.
+        self.est_1block = columns["est_1block"]
+        # The minimum feerate to get included in each block.
+        self.min_feerate = columns["min_feerate"]
+        self.reserve_feerate = columns["reserve_feerate"]
+        self.fallback_feerate = columns["fallback_feerate"]
+        self.me90 = columns["me90"]
+        self.q20_90 = columns["q20_90"]
+        # Built on first use, see first_confirmation_height()
+        self.min_feerate_index = None
+
+    def __len__(self):
+        return len(self.est_1block)
+
+    def end_height(self):
+        """The height of the block right after the last one in the history."""
+        return self.start_height + len(self)
+
+    def first_confirmation_height(self, feerate, height):
+        """The first height from {height} at which a transaction paying {feerate}
+        would confirm, None if it doesn't before the end of the history."""
+        if self.min_feerate_index is None:
+            self.min_feerate_index = FirstBelowIndex(
+                self.start_height, self.min_feerate
+            )
+        return self.min_feerate_index.first_below(feerate, height)
+
+    def columns(self):
+        return {col: getattr(self, col) for col in COLUMNS}
+
+    @classmethod
+    def from_csv(cls, hist_feerate_csv, reserve_strat, fallback_est_strat):
+        """Read the historical data and compute the rolling stats over it."""
+        check_strats(reserve_strat, fallback_est_strat)
+        hist_df = read_csv(hist_feerate_csv, parse_dates=True, index_col="block_height")
+        heights = hist_df.index.to_numpy()
+        assert (
+            np.diff(heights) == 1
+        ).all(), "The fee history must contain every block in its range"
+
+        logging.debug("Preparing the fee estimation data.")
+        mean_feerate = hist_df["mean_feerate"]
+        columns = {
+            "mean_feerate": as_float_array(mean_feerate),
+            "est_1block": as_float_array(hist_df["est_1block"]),
+            # A "NaN" min feerate used to be read as 0. Note an actual NaN never
+            # lets any transaction confirm.
+            "min_feerate": as_float_array(hist_df["min_feerate"], nan_sentinel=0),
+            "reserve_feerate": as_float_array(
+                rolling_stat(mean_feerate, RESERVE_STRATS[reserve_strat])
+            ),
+            "fallback_feerate": as_float_array(
+                rolling_stat(mean_feerate, FALLBACK_EST_STRATS[fallback_est_strat])
+            ),
+            "me90": as_float_array(rolling_stat(mean_feerate, ME90)),
+            "q20_90": as_float_array(rolling_stat(mean_feerate, Q20_90)),
+        }
+        logging.debug("Done processing the fee estimation data.")
+
+        return cls(int(heights[0]), columns)
+
+    def save(self, path):
+        """Write the series to the {path} directory, one .npy file per series."""
+        os.makedirs(path, exist_ok=True)
+        for col, array in self.columns().items():
+            np.save(os.path.join(path, f"{col}.npy"), array)
+        # Written last, its presence means the entry is complete.
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"start_height": self.start_height}, f)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """Read the series written to the {path} directory by `save`.
+
+        If {mmap} is set the files are mapped read-only instead of being read, so
+        that all the processes loading the same entry share a single copy of the
+        series through the page cache.
+        """
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        columns = {}
+        for col in COLUMNS:
+            array = np.load(os.path.join(path, f"{col}.npy"), mmap_mode=mmap_mode)
+            # Use a plain ndarray view on the memmap, indexing it is much faster.
+            columns[col] = array.view(np.ndarray)
+        return cls(meta["start_height"], columns)
+
+
+def cached_fee_history_path(
+    hist_feerate_csv, reserve_strat, fallback_est_strat, cache_dir=None
+):
+    """Get the path to the cached fee history for these strategies, computing it
+    only if it isn't cached yet.
+
+    The cache entries live in {cache_dir} and are keyed by the content of the CSV,
+    the strategies and their parameters.
+    """
+    check_strats(reserve_strat, fallback_est_strat)
+    cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+    key = cache_key(file_hash(hist_feerate_csv), reserve_strat, fallback_est_strat)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return path
+
+    fee_history = FeeHistory.from_csv(
+        hist_feerate_csv, reserve_strat, fallback_est_strat
+    )
+
+    # Write to a temporary directory first and move it in place once complete, as
+    # concurrent simulations may populate the cache at the same time.
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=f".{key}-")
+    try:
+        fee_history.save(tmp_path)
+        os.rename(tmp_path, path)
+        logging.debug(f"Stored the fee estimation data in cache at '{path}'.")
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        # Fine if someone else populated this entry in the meantime
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise
+
+    return path
+
+
+def load_fee_history(
+    hist_feerate_csv, reserve_strat, fallback_est_strat, cache_dir=None
+):
+    """Get the fee history for these strategies, from the cache if possible.
+
+    See `cached_fee_history_path`.
+    """
+    path = cached_fee_history_path(
+        hist_feerate_csv, reserve_strat, fallback_est_strat, cache_dir
+    )
+    logging.debug(f"Loading the fee estimation data from cache at '{path}'.")
+    return FeeHistory.load(path, mmap=True)
@@ -40,23 +40,6 @@ def main(conf, return_results=False, show_plot=False):
         )
         sys.exit(1)
 
-    plot_types = [
-        conf["PLOT_BALANCE"],
-        conf["PLOT_CUM_OP_COST"],
-        conf["PLOT_DIVERGENCE"],
-        conf["PLOT_OP_COST"],
-        conf["PLOT_OVERPAYMENTS"],
-        conf["PLOT_RISK_STATUS"],
-        conf["PLOT_FB_COINS_DIST"],
-    ]
-    if len([plot for plot in plot_types if plot is True]) < 2:
-        logging.error(
-            "Must generate at least two plot types to run simulation. Plot types are:"
-            " PLOT_BALANCE, PLOT_CUM_PLOT_OP_COST, PLOT_DIVERGENCE, PLOT_OP_COST,"
-            " PLOT_OVERPAYMENTS, PLOT_RISK_STATUS, or PLOT_FB_COINS_DIST."
-        )
-        sys.exit(1)
-
     logging.info(f"Configuration:\n{conf}")
 
     sim = Simulation(
@@ -83,6 +66,13 @@ def main(conf, return_results=False, show_plot=False):
         with_overpayments=conf["PLOT_OVERPAYMENTS"],
         with_risk_status=conf["PLOT_RISK_STATUS"],
         with_fb_coins_dist=conf["PLOT_FB_COINS_DIST"],
+        fee_cache_dir=conf["FEE_CACHE_DIR"],
+        fee_history_path=conf["FEE_HISTORY_PATH"],
+        event_driven=conf["EVENT_DRIVEN"],
+        prng_seed=int(conf["PRNG_SEED"]),
+        metrics_stride=int(conf["METRICS_STRIDE"]),
+        metrics_dir=conf["METRICS_DIR"],
+        coin_pool=conf["COIN_POOL"],
     )
 
     start_block = 350000
@@ -100,7 +90,12 @@ def main(conf, return_results=False, show_plot=False):
     else:
         sim.run(start_block, end_block)
 
-        (report, report_df) = sim.plot(conf['PLOT_FILENAME'], show_plot)
+        # Don't bother plotting if the plot is neither saved nor shown, just compute
+        # the report.
+        if conf["PLOT_FILENAME"] is not None or show_plot:
+            report, report_df = sim.plot(conf["PLOT_FILENAME"], show_plot)
+        else:
+            report, report_df = sim.report()
         logging.info(f"Report\n{report}")
 
         if conf["REPORT_FILENAME"] is not None:
@@ -124,6 +119,8 @@ if __name__ == "__main__":
         "N_MAN": os.getenv("N_MAN", 3),
         "LOCKTIME": os.getenv("LOCKTIME", 24),
         "HIST_CSV": os.getenv("HIST_CSV", "../block_fees/historical_fees.csv"),
+        "FEE_CACHE_DIR": os.getenv("FEE_CACHE_DIR", None),
+        "FEE_HISTORY_PATH": os.getenv("FEE_HISTORY_PATH", None),
         "RESERVE_STRAT": os.getenv("RESERVE_STRAT", "CUMMAX95Q90"),
         "FALLBACK_EST_STRAT": os.getenv("FALLBACK_EST_STRAT", "85Q1H"),
         "CF_COIN_SELECTION": os.getenv("CF_COIN_SELECTION", 1),
@@ -144,8 +141,16 @@ if __name__ == "__main__":
         "PLOT_OVERPAYMENTS": bool(int(os.getenv("PLOT_OVERPAYMENTS", 0))),
         "PLOT_RISK_STATUS": bool(int(os.getenv("PLOT_RISK_STATUS", 0))),
         "PLOT_FB_COINS_DIST": bool(int(os.getenv("PLOT_FB_COINS_DIST", 0))),
+        "EVENT_DRIVEN": bool(int(os.getenv("EVENT_DRIVEN", 0))),
+        "COIN_POOL": os.getenv("COIN_POOL", "object"),
+        "METRICS_STRIDE": os.getenv("METRICS_STRIDE", 1),
+        "METRICS_DIR": os.getenv("METRICS_DIR", None),
         "LOG_LEVEL": os.getenv("LOG_LEVEL", "DEBUG").upper(),
         "PRNG_SEED": os.getenv("PRNG_SEED", 21000000),
     }
 
-    main(configuration, return_results=False, show_plot=True)
+    main(
+        configuration,
+        return_results=False,
+        show_plot=bool(int(os.getenv("SHOW_PLOT", 1))),
+    )
@@ -0,0 +1,311 @@
+import json
+import math
+import numpy as np
+import os
+import shutil
+
+from pandas import DataFrame, concat
+
+# The capacity of a series when we can't know in advance how many rows it will hold
+DEFAULT_CAPACITY = 1024
+# The number of rows a series streamed to disk holds in memory before flushing them
+CHUNK_SIZE = 2**16
+
+
+def same_values(a, b):
+    """Whether two rows hold the same values, considering NaN equal to NaN."""
+    return all(x == y or (x != x and y != y) for x, y in zip(a, b))
+
+
+class NpyChunkSink:
+    """Stores series in the {directory}, as chunks of rows in .npy files.
+
+    Each series has its own sub-directory, where the heights and the values of its
+    i-th chunk are written to 'i-heights.npy' and 'i-values.npy'. The description
+    of the series is written to 'meta.json' once it's complete.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def series_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def reset(self, name):
+        """Remove any chunk previously stored for this series."""
+        path = self.series_path(name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    def write_chunk(self, name, index, heights, data):
+        path = self.series_path(name)
+        np.save(os.path.join(path, f"{index}-heights.npy"), heights)
+        np.save(os.path.join(path, f"{index}-values.npy"), data)
+
+    def read_chunk(self, name, index):
+        """The heights and values of a chunk. The files are mapped, not read."""
+        path = self.series_path(name)
+        return (
+            np.load(os.path.join(path, f"{index}-heights.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, f"{index}-values.npy"), mmap_mode="r"),
+        )
+
+    def write_meta(self, name, meta):
+        path = os.path.join(self.series_path(name), "meta.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def read_meta(self, name):
+        path = os.path.join(self.series_path(name), "meta.json")
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+
+class BlockSeries:
+    """Values of some metrics at each block, stored in typed NumPy columns.
+
+    Only the blocks at a multiple of {stride} from the first one are recorded. If
+    {change_only} is set, a row is only stored if it differs from the previous one
+    (the series is run-length encoded). In any case the series is read back with a
+    row per recorded block. A change-only series must therefore be recorded at
+    every block, or a skipped block would be read back with the previous values.
+
+    A missing value (None) is stored as NaN, so {dtype} must be a float type for
+    the columns that may miss values.
+
+    If a {sink} is given, the rows are flushed to it under {name} every {chunk_size}
+    rows, so that the memory used doesn't depend on the length of the series. They
+    are read back from it when needed.
+    """
+
+    def __init__(
+        self,
+        columns,
+        dtype=np.float64,
+        stride=1,
+        change_only=False,
+        sink=None,
+        name=None,
+        chunk_size=CHUNK_SIZE,
+    ):
+        self.columns = columns
+        self.dtype = dtype
+        self.stride = stride
+        self.change_only = change_only
+        self.sink = sink
+        self.name = name
+        self.chunk_size = chunk_size
+        self.allocate(None, None)
+
+    def allocate(self, start_height, end_height):
+        """Discard the recorded rows and preallocate the columns for recording
+        the blocks in [{start_height}, {end_height}[."""
+        self.start_height = start_height
+        if self.change_only or start_height is None:
+            capacity = DEFAULT_CAPACITY
+        else:
+            capacity = math.ceil(max(end_height - start_height, 0) / self.stride)
+        if self.sink is not None:
+            capacity = min(capacity, self.chunk_size)
+            if start_height is not None:
+                self.sink.reset(self.name)
+        self.heights = np.empty(capacity, dtype=np.int64)
+        self.data = np.empty((capacity, len(self.columns)), dtype=self.dtype)
+        # The rows in memory, and the number of chunks flushed to the sink
+        self.n_rows = 0
+        self.n_chunks = 0
+        # The number of rows stored, and the first height stored
+        self.n_stored = 0
+        self.first_height = None
+        # The last height recorded, and the values recorded at this height
+        self.last_height = None
+        self.last_values = None
+
+    @classmethod
+    def load(cls, sink, name):
+        """The series stored under {name} in the {sink}. Its chunks are only read
+        when needed."""
+        meta = sink.read_meta(name)
+        series = cls(
+            meta["columns"],
+            dtype=np.dtype(meta["dtype"]),
+            stride=meta["stride"],
+            change_only=meta["change_only"],
+        )
+        series.sink, series.name = sink, name
+        for key in ["n_chunks", "n_stored", "first_height", "last_height"]:
+            setattr(series, key, meta[key])
+        return series
+
+    def __len__(self):
+        """The number of blocks recorded."""
+        if not self.change_only or self.n_stored == 0:
+            return self.n_stored
+        return (self.last_height - self.first_height) // self.stride + 1
+
+    def is_recorded(self, height):
+        if self.start_height is None:
+            self.start_height = height
+        return (height - self.start_height) % self.stride == 0
+
+    def grow(self, n_rows):
+        """Make sure there is room for {n_rows} more rows in memory."""
+        needed = self.n_rows + n_rows
+        if needed <= len(self.heights):
+            return
+        capacity = max(needed, 2 * len(self.heights))
+        heights = np.empty(capacity, dtype=np.int64)
+        heights[: self.n_rows] = self.heights[: self.n_rows]
+        data = np.empty((capacity, len(self.columns)), dtype=self.dtype)
+        data[: self.n_rows] = self.data[: self.n_rows]
+        self.heights, self.data = heights, data
+
+    def store(self, heights, rows):
+        """Append these rows, flushing them to the sink by chunks if there is
+        one."""
+        if len(heights) == 0:
+            return
+        if self.first_height is None:
+            self.first_height = int(heights[0])
+        self.n_stored += len(heights)
+        while len(heights) > 0:
+            n = len(heights)
+            if self.sink is not None:
+                n = min(n, self.chunk_size - self.n_rows)
+            self.grow(n)
+            self.heights[self.n_rows : self.n_rows + n] = heights[:n]
+            self.data[self.n_rows : self.n_rows + n] = rows[:n]
+            self.n_rows += n
+            heights, rows = heights[n:], rows[n:]
+            if self.sink is not None and self.n_rows == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """Write the rows in memory to the sink."""
+        if self.n_rows == 0:
+            return
+        self.sink.write_chunk(
+            self.name,
+            self.n_chunks,
+            self.heights[: self.n_rows],
+            self.data[: self.n_rows],
+        )
+        self.n_chunks += 1
+        self.n_rows = 0
+
+    def close(self):
+        """Flush the rows still in memory and describe the series in the sink, so
+        that it can be loaded back."""
+        if self.sink is None:
+            return
+        self.flush()
+        self.sink.write_meta(
+            self.name,
+            {
+                "columns": self.columns,
+                "dtype": np.dtype(self.dtype).str,
+                "stride": self.stride,
+                "change_only": self.change_only,
+                "n_chunks": self.n_chunks,
+                "n_stored": self.n_stored,
+                "first_height": self.first_height,
+                "last_height": self.last_height,
+            },
+        )
+
+    def record(self, height, *values):
+        """Record the {values} of the metrics at this {height}."""
+        if not self.is_recorded(height):
+            return
+        values = tuple(np.nan if v is None else v for v in values)
+        if (
+            self.change_only
+            and self.last_values is not None
+            and same_values(values, self.last_values)
+        ):
+            self.last_height = height
+            return
+        self.store([height], [values])
+        self.last_height, self.last_values = height, values
+
+    def record_range(self, start_height, end_height, *values):
+        """Record the metrics at each height in [{start_height}, {end_height}[ at
+        once. Each of the {values} is either the same at all these heights, or an
+        array with the value at each of them."""
+        self.is_recorded(start_height)
+        first = start_height + (self.start_height - start_height) % self.stride
+        heights = np.arange(first, end_height, self.stride)
+        if len(heights) == 0:
+            return
+        rows = np.empty((len(heights), len(self.columns)), dtype=self.dtype)
+        for i, value in enumerate(values):
+            if np.ndim(value) > 0:
+                rows[:, i] = np.asarray(value)[heights - start_height]
+            else:
+                rows[:, i] = np.nan if value is None else value
+        last_height, last_values = int(heights[-1]), tuple(rows[-1].tolist())
+
+        if self.change_only:
+            # Only keep the rows that differ from the one before them
+            previous = np.empty_like(rows)
+            previous[1:] = rows[:-1]
+            if self.last_values is not None:
+                previous[0] = self.last_values
+            changed = (rows != previous) & ~(np.isnan(rows) & np.isnan(previous))
+            if self.last_values is None:
+                changed[0] = True
+            keep = changed.any(axis=1)
+            heights, rows = heights[keep], rows[keep]
+
+        self.store(heights, rows)
+        self.last_height, self.last_values = last_height, last_values
+
+    def chunks(self):
+        """The stored heights and (rows, columns) arrays of values, by chunk: first
+        those flushed to the sink, then those in memory."""
+        for index in range(self.n_chunks):
+            yield self.sink.read_chunk(self.name, index)
+        if self.n_rows > 0:
+            yield self.heights[: self.n_rows], self.data[: self.n_rows]
+
+    def frame(self, heights, data, end_height, block_column):
+        """A DataFrame with a row per recorded block from these stored rows, the
+        last of them holding until {end_height} (excluded)."""
+        if self.change_only:
+            # Expand the runs of identical rows
+            ends = np.append(heights[1:], end_height)
+            data = np.repeat(data, (ends - heights) // self.stride, axis=0)
+            heights = np.arange(heights[0], end_height, self.stride)
+        # Copy the chunks read from the sink, not to keep their files mapped
+        df = DataFrame(np.array(data), columns=self.columns)
+        df.insert(0, block_column, np.array(heights))
+        return df
+
+    def frames(self, block_column="block"):
+        """The recorded series as a DataFrame per chunk, to go through it without
+        loading all of it in memory."""
+        previous = None
+        for heights, data in self.chunks():
+            if previous is not None:
+                yield self.frame(*previous, heights[0], block_column)
+            previous = (heights, data)
+        if previous is not None:
+            yield self.frame(*previous, self.last_height + self.stride, block_column)
+
+    def to_frame(self, block_column="block"):
+        """The recorded series as a DataFrame, with a row per recorded block."""
+        frames = list(self.frames(block_column))
+        if frames == []:
+            return DataFrame(columns=[block_column] + self.columns)
+        return concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def load_metrics(directory):
+    """The series stored in this {directory} by a simulation run, by name (see the
+    {metrics_dir} parameter of the Simulation)."""
+    sink = NpyChunkSink(directory)
+    return {
+        name: BlockSeries.load(sink, name)
+        for name in sorted(os.listdir(directory))
+        if os.path.exists(os.path.join(sink.series_path(name), "meta.json"))
+    }
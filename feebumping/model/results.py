@@ -1,12 +1,15 @@
+import hashlib
 import logging
 import multiprocessing as mp
+import numpy as np
 import os
 from pandas import DataFrame
 import pandas as pd
 import random
 import sys
-from functools import partial
-from simulation import Simulation
+import traceback
+from fee_history import cached_fee_history_path
+from simulation import Simulation, REPORT_COLUMNS
 import json
 from main import main
 
@@ -15,40 +18,153 @@ NUM_CORES = int(os.getenv("NUM_CORES", 1))
 REPEATS_PER_CORE = int(os.getenv("REPEATS_PER_CORE", 1))
 STUDY_TYPE = os.getenv("STUDY_TYPE", None)
 VAL_RANGE = json.loads(os.getenv("VAL_RANGE", None))
+# Whether to run again the simulations that failed in a previous run of the study
+RETRY_FAILED = bool(int(os.getenv("RETRY_FAILED", 0)))
 RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
 os.makedirs(RESULTS_DIR, exist_ok=True)
+# The configuration entries specific to each simulation of a study
+CELL_CONFIG_KEYS = [
+    STUDY_TYPE,
+    "PRNG_SEED",
+    "REPORT_FILENAME",
+    "METRICS_DIR",
+    "FEE_HISTORY_PATH",
+    "LOG_LEVEL",
+    "PROFILE_FILENAME",
+]
 
 
-def sim_process(prng_seed, val, config):
+def sim_process(task):
+    """Run the simulation for a single (value, seed) cell of the study.
+
+    Returns the simulation report, or the exception that made it fail.
+    """
+    val, prng_seed, config = task
     # set sim specific env vars
     config["PRNG_SEED"] = f"{prng_seed}"
     config["REPORT_FILENAME"] = os.path.join(
         RESULTS_DIR, f"report_{STUDY_TYPE}_{val}-PRNG_{prng_seed}"
     )
+    # Each simulation streams its per-block series to its own directory
+    if config["METRICS_DIR"] is not None:
+        config["METRICS_DIR"] = os.path.join(
+            config["METRICS_DIR"], f"{STUDY_TYPE}_{val}-PRNG_{prng_seed}"
+        )
 
     logging.info(f"Simulating with {STUDY_TYPE} = {val}, prng_seed = {prng_seed}\n")
 
     try:
-        return main(conf=config, return_results=True)
-    except (RuntimeError):
-        # FIXME: return empty report_df?
-        logging.info(f"RuntimeError: Simulating with {study_type} = {val} failed.")
+        return val, prng_seed, main(conf=config, return_results=True), None
+    except Exception as e:
+        logging.error(
+            f"Simulating with {STUDY_TYPE} = {val}, prng_seed = {prng_seed}"
+            f" failed: {repr(e)}"
+        )
+        return val, prng_seed, None, f"{repr(e)}\n{traceback.format_exc()}"
 
 
-def multiprocess_run(val, config, range_seed):
-    # FIXME: what if process fails?
-    assert len(range_seed) >= 2
-    cores = len(range_seed)
-    print(
-        f"Multiprocess run with {STUDY_TYPE}: {val} and prng seed range: {range_seed}"
+def run_study(tasks):
+    """Run all the simulations of the study through a single pool of NUM_CORES
+    workers.
+
+    Tasks are handed out one at a time to the first idle worker, so that a slow
+    simulation never holds back the others. The results are yielded as they
+    complete, in no particular order.
+    """
+    with mp.Pool(processes=NUM_CORES) as pool:
+        yield from pool.imap_unordered(sim_process, tasks, chunksize=1)
+
+
+def study_store_path(report_name, config):
+    """The file the result of each simulation of this study is appended to.
+
+    It is named after the configuration shared by all the simulations of the
+    study, so that changing it starts a new study instead of mixing results.
+    """
+    shared_config = {k: v for k, v in config.items() if k not in CELL_CONFIG_KEYS}
+    digest = hashlib.sha256(
+        json.dumps(shared_config, sort_keys=True).encode()
+    ).hexdigest()
+    return os.path.join(RESULTS_DIR, f"{report_name}-{digest[:16]}.jsonl")
+
+
+def load_study_results(path):
+    """Read the results of the simulations that already completed for this study,
+    as a mapping from (value, seed) to the stored record."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may have been truncated if we were interrupted
+                continue
+            results[(record["val"], record["seed"])] = record
+    return results
+
+
+def store_study_result(store, val, seed, report_df, error):
+    """Append the result of a simulation to the study store, and return the
+    stored record."""
+    record = {"val": val, "seed": seed}
+    if error is not None:
+        record["error"] = error
+    else:
+        record["report"] = {
+            col: value.item() if isinstance(value, np.generic) else value
+            for col, value in report_df.iloc[0].items()
+        }
+    store.write(json.dumps(record) + "\n")
+    store.flush()
+    os.fsync(store.fileno())
+    return record
+
+
+def value_report(report_name, val, config, seeds, records):
+    """Write the report of all the simulations run for this value of the studied
+    parameter, and return its row in the study results."""
+    failures = [records[seed] for seed in seeds if "error" in records[seed]]
+    report = (
+        f"{report_name}\nnumber of simulations:"
+        f" {len(seeds)}\nseeds used:"
+        f" {seeds[0]}-{seeds[0] + len(seeds)}\nfailed simulations:"
+        f" {len(failures)}\nconfig: {config}\n\nResults:\n"
+    )
+
+    # Failed simulations are not accounted for in the statistics
+    stats_df = DataFrame(
+        [records[seed]["report"] for seed in seeds if "report" in records[seed]],
+        columns=REPORT_COLUMNS,
     )
 
-    with mp.Pool(processes=cores) as pool:
-        dfs = pool.map(partial(sim_process, val=val, config=config), range_seed)
-        results_df = dfs[0]
-        for df in dfs[1:]:
-            results_df = pd.concat([results_df, df], axis=0)
-        return results_df
+    row = [val]
+    for col in stats_df.columns:
+        report += f"{col} mean:    {stats_df[col].mean()}\n"
+        report += f"{col} std dev: {stats_df[col].std()}\n"
+        row.append(stats_df[col].mean())
+        row.append(stats_df[col].std())
+
+    if failures != []:
+        report += "\nFailures:\n"
+        for record in failures:
+            report += f"seed {record['seed']}: {record['error']}\n"
+
+    with open(f"{RESULTS_DIR}/{report_name}-{val}.txt", "w+", encoding="utf-8") as f:
+        f.write(report)
+
+    return row
+
+
+def write_study_csv(report_name, report_rows):
+    columns = [STUDY_TYPE]
+    for col in REPORT_COLUMNS:
+        columns += [f"{col}_mean", f"{col}_std_dev"]
+    report_df = DataFrame(report_rows, columns=columns)
+    report_df.set_index(f"{STUDY_TYPE}", inplace=True)
+    report_df.to_csv(f"{RESULTS_DIR}/{report_name}")
 
 
 if __name__ == "__main__":
@@ -98,6 +214,8 @@ if __name__ == "__main__":
         "N_MAN": os.getenv("N_MAN", 3),
         "LOCKTIME": os.getenv("LOCKTIME", 24),
         "HIST_CSV": os.getenv("HIST_CSV", "../block_fees/historical_fees.csv"),
+        "FEE_CACHE_DIR": os.getenv("FEE_CACHE_DIR", None),
+        "FEE_HISTORY_PATH": None,
         "RESERVE_STRAT": os.getenv("RESERVE_STRAT", "CUMMAX95Q90"),
         "FALLBACK_EST_STRAT": os.getenv("FALLBACK_EST_STRAT", "85Q1H"),
         "CF_COIN_SELECTION": os.getenv("CF_COIN_SELECTION", 1),
@@ -117,78 +235,73 @@ if __name__ == "__main__":
         "PLOT_OVERPAYMENTS": False,
         "PLOT_RISK_STATUS": False,
         "PLOT_FB_COINS_DIST": False,
+        "EVENT_DRIVEN": bool(int(os.getenv("EVENT_DRIVEN", 0))),
+        "COIN_POOL": os.getenv("COIN_POOL", "object"),
+        "METRICS_STRIDE": os.getenv("METRICS_STRIDE", 1),
+        "METRICS_DIR": os.getenv("METRICS_DIR", None),
         "LOG_LEVEL": os.getenv("LOG_LEVEL", "DEBUG").upper(),
         "PRNG_SEED": os.getenv("PRNG_SEED", 21000000),
     }
 
-    # Generate results
-    report_rows = []
+    # The results of the simulations are stored as they complete. If this study
+    # was already (partially) run, resume it by only running the missing
+    # simulations. Add seeds by increasing REPEATS_PER_CORE.
+    store_path = study_store_path(report_name, config)
+    done = load_study_results(store_path)
+    if RETRY_FAILED:
+        done = {cell: r for cell, r in done.items() if "error" not in r}
+
+    # Expand the study into one simulation per (value, seed) pair. The fee history
+    # is prepared once per value, the workers map it read-only instead of each
+    # parsing the CSV and holding their own copy.
+    first_seed = int(config["PRNG_SEED"])
+    seeds = list(range(first_seed, first_seed + NUM_CORES * REPEATS_PER_CORE))
+    val_configs = {}
+    sim_results = {}
+    tasks = []
     for val in VAL_RANGE:
-        range_seed = list(range(config['PRNG_SEED'], config['PRNG_SEED'] + NUM_CORES))
-        config[STUDY_TYPE] = val
-        report = (
-            f"{report_name}\nnumber of simulations:"
-            f" {REPEATS_PER_CORE*NUM_CORES}\nseeds used:"
-            f" {range_seed[0]}-{range_seed[0]+(REPEATS_PER_CORE*NUM_CORES)}\nconfig:"
-            f" {config}\n\nResults:\n"
+        val_config = dict(config)
+        val_config[STUDY_TYPE] = val
+        val_config["FEE_HISTORY_PATH"] = cached_fee_history_path(
+            val_config["HIST_CSV"],
+            val_config["RESERVE_STRAT"],
+            val_config["FALLBACK_EST_STRAT"],
+            val_config["FEE_CACHE_DIR"],
         )
+        val_configs[val] = val_config
+        sim_results[val] = {
+            seed: done[(val, seed)] for seed in seeds if (val, seed) in done
+        }
+        tasks += [
+            (val, seed, val_config) for seed in seeds if seed not in sim_results[val]
+        ]
+    print(
+        f"Running {len(tasks)} simulations with {STUDY_TYPE} in {VAL_RANGE} and prng"
+        f" seed range: {seeds[0]}-{seeds[-1]}, on {NUM_CORES} cores"
+        f" ({len(VAL_RANGE) * len(seeds) - len(tasks)} already done, stored in"
+        f" '{store_path}')"
+    )
 
-        sim_results = []
-        for i in range(0, REPEATS_PER_CORE):
-            result = multiprocess_run(val, config, range_seed)
-            sim_results.append(result)
-            range_seed = [s + NUM_CORES for s in range_seed]
-
-        stats_df = sim_results[0]
-        for df in sim_results:
-            stats_df = pd.concat([stats_df, df], axis=0)
-
-        row = [val]
-        for col in stats_df.columns:
-            report += f"{col} mean:    {stats_df[col].mean()}\n"
-            report += f"{col} std dev: {stats_df[col].std()}\n"
-            row.append(stats_df[col].mean())
-            row.append(stats_df[col].std())
-        report_rows.append(row)
-        with open(
-            f"{RESULTS_DIR}/{report_name}-{val}.txt", "w+", encoding="utf-8"
-        ) as f:
-            f.write(report)
+    # Generate results, reporting about each value as soon as all its simulations
+    # completed.
+    report_rows = {}
 
+    def maybe_report(val):
+        if len(sim_results[val]) < len(seeds):
+            return
+        report_rows[val] = value_report(
+            report_name, val, val_configs[val], seeds, sim_results[val]
+        )
         # Save the csv at each val in case of failure
-        report_df = DataFrame(
-            report_rows,
-            columns=[
-                STUDY_TYPE,
-                "mean_balance_mean",
-                "mean_balance_std_dev",
-                "cum_ops_cost_mean",
-                "cum_ops_cost_std_dev",
-                "cum_cancel_fee_mean",
-                "cum_cancel_fee_std_dev",
-                "cum_cf_fee_mean",
-                "cum_cf_fee_std_dev",
-                "cum_refill_fee_mean",
-                "cum_refill_fee_std_dev",
-                "time_at_risk_mean",
-                "time_at_risk_std_dev",
-                "mean_recovery_time_mean",
-                "mean_recovery_time_std_dev",
-                "median_recovery_time_mean",
-                "median_recovery_time_std_dev",
-                "max_recovery_time_mean",
-                "max_recovery_time_std_dev",
-                "delegation_failure_count_mean",
-                "delegation_failure_count_std_dev",
-                "delegation_failure_rate_mean",
-                "delegation_failure_rate_std_dev",
-                "max_cancel_conf_time_mean",
-                "max_cancel_conf_time_std_dev",
-                "max_cf_conf_time_mean",
-                "max_cf_conf_time_std_dev",
-                "max_risk_coef_mean",
-                "max_risk_coef_std_dev",
-            ],
+        write_study_csv(
+            report_name, [report_rows[v] for v in VAL_RANGE if v in report_rows]
         )
-        report_df.set_index(f"{STUDY_TYPE}", inplace=True)
-        report_df.to_csv(f"{RESULTS_DIR}/{report_name}")
+
+    for val in VAL_RANGE:
+        maybe_report(val)
+    with open(store_path, "a", encoding="utf-8") as store:
+        for val, seed, report_df, error in run_study(tasks):
+            sim_results[val][seed] = store_study_result(
+                store, val, seed, report_df, error
+            )
+            maybe_report(val)
@@ -1,10 +1,11 @@
+import heapq
 import logging
 import math
 import numpy as np
 import random
 
-from matplotlib import pyplot as plt
-from pandas import DataFrame
+from metrics import BlockSeries, NpyChunkSink
+from pandas import DataFrame, Series
 from statemachine import StateMachine, AllocationError, ProcessingState
 from transactions import ConsolidateFanoutTx, CancelTx
 from utils import (
@@ -18,11 +19,106 @@ from utils import (
     VAULT_AMOUNT,
 )
 
+# The metrics reported about a simulation run
+REPORT_COLUMNS = [
+    "mean_balance",
+    "cum_ops_cost",
+    "cum_cancel_fee",
+    "cum_cf_fee",
+    "cum_refill_fee",
+    "time_at_risk",
+    "mean_recovery_time",
+    "median_recovery_time",
+    "max_recovery_time",
+    "delegation_failure_count",
+    "delegation_failure_rate",
+    "max_cancel_conf_time",
+    "max_cf_conf_time",
+    "max_risk_coef",
+]
+
 
 class NoVaultToSpend(RuntimeError):
     pass
 
 
+# The kinds of stochastic events, in the order their streams are spawned
+EVENT_KINDS = ("delegation", "unvault", "invalid_spend", "catastrophe")
+
+
+def draw_workload(seed, start_height, end_height, rates, invalid_spend_rate):
+    """Draw the stochastic events happening in [{start_height}, {end_height}[.
+
+    Each kind of event in {rates} happens at each block with this probability. An
+    "invalid_spend" happens along with an unvault with probability
+    {invalid_spend_rate}. Each kind is drawn at once for the whole range, from its
+    own stream derived from {seed}. A kind of event therefore always occurs at the
+    same heights for a given seed, whatever the other rates are.
+
+    Returns the heights of the events in increasing order, and their kind as an
+    index in EVENT_KINDS.
+    """
+    streams = dict(
+        zip(
+            EVENT_KINDS,
+            (
+                np.random.default_rng(s)
+                for s in np.random.SeedSequence(seed).spawn(len(EVENT_KINDS))
+            ),
+        )
+    )
+    n_blocks = max(end_height - start_height, 0)
+    heights, kinds = [], []
+    for kind, rate in rates.items():
+        occurs = np.flatnonzero(streams[kind].random(n_blocks) < rate)
+        heights.append(occurs + start_height)
+        kinds.append(np.full(len(occurs), EVENT_KINDS.index(kind), dtype=np.int8))
+        if kind == "unvault":
+            invalid = streams["invalid_spend"].random(len(occurs)) < invalid_spend_rate
+            heights.append(occurs[invalid] + start_height)
+            kinds.append(
+                np.full(
+                    np.count_nonzero(invalid),
+                    EVENT_KINDS.index("invalid_spend"),
+                    dtype=np.int8,
+                )
+            )
+    heights = np.concatenate(heights) if heights != [] else np.empty(0, np.int64)
+    kinds = np.concatenate(kinds) if kinds != [] else np.empty(0, np.int8)
+    order = np.argsort(heights, kind="stable")
+    return heights[order], kinds[order]
+
+
+def events_by_height(heights, kinds):
+    """Map each height at which an event happens to the kinds of its events."""
+    events = {}
+    for height, kind in zip(heights.tolist(), kinds.tolist()):
+        events.setdefault(height, set()).add(EVENT_KINDS[kind])
+    return events
+
+
+class RunStats:
+    """The metrics updated at every block of a simulation run.
+
+    They are kept as plain Python integers and only copied to the report
+    DataFrame once the run is over. None until a transaction was observed.
+    """
+
+    __slots__ = ("max_cancel_conf_time", "max_cf_conf_time")
+
+    def __init__(self):
+        self.max_cancel_conf_time = None
+        self.max_cf_conf_time = None
+
+    def record_cancel_conf_time(self, conf_time):
+        if self.max_cancel_conf_time is None or conf_time > self.max_cancel_conf_time:
+            self.max_cancel_conf_time = conf_time
+
+    def record_cf_conf_time(self, conf_time):
+        if self.max_cf_conf_time is None or conf_time > self.max_cf_conf_time:
+            self.max_cf_conf_time = conf_time
+
+
 class Simulation(object):
     """Simulator for fee-reserve management of a Revault Watchtower."""
 
@@ -51,6 +147,13 @@ class Simulation(object):
         with_risk_status=False,
         with_risk_time=False,
         with_fb_coins_dist=False,
+        fee_cache_dir=None,
+        fee_history_path=None,
+        event_driven=False,
+        prng_seed=None,
+        metrics_stride=1,
+        metrics_dir=None,
+        coin_pool="object",
     ):
         # Simulation parameters
         self.num_vaults = num_vaults
@@ -59,6 +162,12 @@ class Simulation(object):
         self.unvault_rate = unvault_rate
         self.delegate_rate = delegate_rate
 
+        # Whether to only go through the blocks at which something happens (see
+        # run_events())
+        self.event_driven = event_driven
+        # The seed the stochastic events are drawn from (see draw_workload())
+        self.prng_seed = prng_seed if prng_seed is not None else random.getrandbits(64)
+
         # Manager parameters
         self.invalid_spend_rate = invalid_spend_rate
         self.catastrophe_rate = catastrophe_rate
@@ -73,22 +182,52 @@ class Simulation(object):
             fallback_est_strat,
             cf_coin_selec,
             cancel_coin_selec,
+            fee_cache_dir,
+            fee_history_path,
+            coin_pool,
         )
         self.vault_id = 0
 
-        # Plots configuration
+        # Plots configuration. The per-block series are only recorded every
+        # {metrics_stride} blocks, except for the costs as they are cumulated. The
+        # balances and the costs seldom change, only their changes are stored.
+        # If {metrics_dir} is set, the series are streamed to this directory rather
+        # than kept in memory (see metrics.load_metrics() to read them back).
+        sink = NpyChunkSink(metrics_dir) if metrics_dir is not None else None
         self.with_balance = with_balance
-        self.balances = []
+        self.balances = BlockSeries(
+            ["Balance", "Required Reserve", "Unallocated Balance"],
+            dtype=np.int64,
+            stride=metrics_stride,
+            change_only=True,
+            sink=sink,
+            name="balances",
+        )
         self.with_divergence = with_divergence
-        self.divergence = []
+        self.divergence = BlockSeries(
+            ["MeanDivergence", "MinDivergence", "MaxDivergence"],
+            stride=metrics_stride,
+            sink=sink,
+            name="divergence",
+        )
         self.with_op_cost = with_op_cost
         self.with_cum_op_cost = with_cum_op_cost
-        self.costs = []
+        self.costs = BlockSeries(
+            ["Refill Fee", "CF Fee", "Cancel Fee"],
+            change_only=True,
+            sink=sink,
+            name="costs",
+        )
         self.wt_risk_time = []
         self.with_overpayments = with_overpayments
         self.overpayments = []
         self.with_risk_status = with_risk_status
-        self.risk_status = []
+        self.risk_status = BlockSeries(
+            ["risk coefficient"],
+            stride=metrics_stride,
+            sink=sink,
+            name="risk_status",
+        )
         self.with_fb_coins_dist = with_fb_coins_dist
         self.fb_coins_dist = []
         self.scale_fixed = delegate_rate is None
@@ -96,6 +235,7 @@ class Simulation(object):
         # Simulation report
         self.delegation_failures = 0
         self.delegation_successes = 0
+        self.stats = RunStats()
         self.report_init = f"""\
         Watchtower config:\n\
             n_stk: {n_stk}\n\
@@ -116,25 +256,7 @@ class Simulation(object):
             Catastrophe rate: {self.catastrophe_rate}\n\
             Delegate rate: {self.delegate_rate}\n\
         """
-        self.report_df = DataFrame(
-            columns=[
-                "mean_balance",
-                "cum_ops_cost",
-                "cum_cancel_fee",
-                "cum_cf_fee",
-                "cum_refill_fee",
-                "time_at_risk",
-                "mean_recovery_time",
-                "median_recovery_time",
-                "max_recovery_time",
-                "delegation_failure_count",
-                "delegation_failure_rate",
-                "max_cancel_conf_time",
-                "max_cf_conf_time",
-                "max_risk_coef",
-            ],
-            index=[0],
-        )
+        self.report_df = DataFrame(columns=REPORT_COLUMNS, index=[0])
 
     def new_vault_id(self):
         self.vault_id += 1
@@ -147,7 +269,7 @@ class Simulation(object):
         cancel transaction size and the number of vaults: the absolute amount of
         BTC also accounts for the cost of including a coin in the tx vin.
         """
-        return sum(self.wt.fb_coins_dist(block_height))
+        return self.wt.fb_coins_dist(block_height).total
 
     def required_reserve(self, block_height):
         """The total absolute amount of sats the WT should have in reserve."""
@@ -163,7 +285,7 @@ class Simulation(object):
         # First of all get the overall needed reserve
         balance = self.wt.balance()
         target_dist = self.wt.fb_coins_dist(block_height)
-        amount_needed_per_vault = sum(target_dist)
+        amount_needed_per_vault = target_dist.total
         reserve_needed = amount_needed_per_vault * (
             expected_new_vaults + self.wt.vaults_count() + self.refill_excess
         )
@@ -187,7 +309,7 @@ class Simulation(object):
         # as it can from the new refill (rounded up), plus the number of coins it consolidated
         # (hence overestimating)
         new_dists = math.ceil(refill_amount / amount_needed_per_vault)
-        cf_num_outputs = new_dists * len(target_dist)
+        cf_num_outputs = new_dists * len(target_dist.amounts)
         cf_fee = cf_tx_size(cf_num_inputs, cf_num_outputs) * cf_feerate
 
         refill_amount += cf_fee
@@ -195,32 +317,27 @@ class Simulation(object):
 
     def compute_reserve_divergence(self, block_height):
         """Compute how far the vault's reserves have divereged from the current fee reserve per vault.
-        Compute the risk status; the total amount (satoshis) below the required reserve among available vaults."""
-        vaults = self.wt.list_available_vaults()
-        if len(vaults) == 0 or not (self.with_divergence or self.with_risk_status):
+        Compute the risk status; the total amount (satoshis) below the required reserve among available vaults.
+        """
+        reserves = self.wt.reserve_balances()
+        if len(reserves) == 0 or not (self.with_divergence or self.with_risk_status):
             return
 
-        divergence = []
-        for vault in vaults:
-            div = vault.reserve_balance() - self.required_reserve_per_vault(
-                block_height
-            )
-            divergence.append(div)
+        divergence = reserves - self.required_reserve_per_vault(block_height)
         if self.with_divergence:
-            self.divergence.append(
-                [
-                    block_height,
-                    sum(divergence) / len(vaults),
-                    min(divergence),
-                    max(divergence),
-                ]
+            self.divergence.record(
+                block_height,
+                divergence.sum() / len(divergence),
+                divergence.min(),
+                divergence.max(),
             )
 
         if self.with_risk_status:
-            risk_by_vault = [abs(div) for div in divergence if div < 0]
-            nominal_risk = sum(risk_by_vault)
-            risk_coefficient = len(risk_by_vault) / len(vaults) * nominal_risk
-            self.risk_status.append((block_height, risk_coefficient))
+            # The total amount missing among the vaults under requirement
+            risk_by_vault = divergence[divergence < 0]
+            nominal_risk = -risk_by_vault.sum()
+            risk_coefficient = len(risk_by_vault) / len(divergence) * nominal_risk
+            self.risk_status.record(block_height, risk_coefficient)
 
     def broadcast_cf_tx(self, block_height):
         cf_fee = self.wt.broadcast_consolidate_fanout(block_height)
@@ -266,12 +383,9 @@ class Simulation(object):
             self.delegation_failures += 1
 
     def top_up_sequence(self, block_height):
-        # FIXME: that's ugly and confusing. What happens here is that allocate() will
-        # return early if the vault doesn't need to be allocated, hence not raising. We
-        # should check this here instead.
-
-        # loop over copy since allocate may remove an element, changing list index
-        for vault in list(self.wt.list_available_vaults()):
+        # Only the vaults under requirement need to be allocated again. This is a new
+        # list as allocate() removes and re-adds the vault.
+        for vault in self.wt.vaults_under_requirement(block_height):
             try:
                 # Allocation transition
                 logging.info(
@@ -286,20 +400,20 @@ class Simulation(object):
                 )
 
     def spend(self, block_height):
-        if len(self.wt.list_available_vaults()) == 0:
+        if self.wt.available_vaults_count() == 0:
             raise NoVaultToSpend
 
-        vault_id = random.choice(self.wt.list_available_vaults()).id
+        vault_id = self.wt.random_available_vault()
         logging.info(
             f"  Spend transition with vault {vault_id} at block {block_height}"
         )
         self.wt.spend(vault_id, block_height)
 
     def cancel(self, block_height):
-        if len(self.wt.list_available_vaults()) == 0:
+        if self.wt.available_vaults_count() == 0:
             raise NoVaultToSpend
 
-        vault_id = random.choice(self.wt.list_available_vaults()).id
+        vault_id = self.wt.random_available_vault()
         # Cancel transition
         cancel_inputs = self.wt.broadcast_cancel(vault_id, block_height)
         self.cancel_fee = sum(coin.amount for coin in cancel_inputs)
@@ -314,14 +428,15 @@ class Simulation(object):
             self.overpayments.append([block_height, self.cancel_fee - needed_fee])
 
     def catastrophe_sequence(self, block_height):
-        if len(self.wt.list_available_vaults()) == 0:
+        if self.wt.available_vaults_count() == 0:
             raise NoVaultToSpend
 
         self.top_up_sequence(block_height)
         logging.info(f"Catastrophe sequence at block {block_height}")
-        for vault in self.wt.list_available_vaults():
+        # Copy the ids, as cancelling a vault removes it from the available ones
+        for vault_id in list(self.wt.available_vault_ids()):
             # Cancel transition
-            cancel_inputs = self.wt.broadcast_cancel(vault.id, block_height)
+            cancel_inputs = self.wt.broadcast_cancel(vault_id, block_height)
             # If a cancel fee has already been paid this block, sum those fees
             # so that when plotting costs this will appear as one total operation
             # rather than several separate cancel operations
@@ -331,7 +446,7 @@ class Simulation(object):
             else:
                 self.cancel_fee = cancel_fee
             logging.info(
-                f"  Cancel transition with vault {vault.id} for fee: {cancel_fee}"
+                f"  Cancel transition with vault {vault_id} for fee: {cancel_fee}"
             )
 
     def confirm_sequence(self, height):
@@ -340,7 +455,7 @@ class Simulation(object):
         If so, applies the transaction to the state.
         If not, handles rejection for cancel transaction type or does nothing for others.
         """
-        for tx in self.wt.unconfirmed_transactions():
+        for tx in self.wt.unconfirmed_transactions().walk():
             if isinstance(tx, ConsolidateFanoutTx):
                 assert (
                     len(tx.txins) * P2WPKH_INPUT_SIZE
@@ -374,14 +489,220 @@ class Simulation(object):
             else:
                 raise
 
+    def event_rates(self):
+        """The probability for each kind of stochastic event to happen at a block."""
+        # The rates are per day
+        rates = {
+            "unvault": self.unvault_rate / BLOCKS_PER_DAY,
+            "catastrophe": self.catastrophe_rate / BLOCKS_PER_DAY,
+        }
+        if not self.scale_fixed:
+            rates["delegation"] = self.delegate_rate / BLOCKS_PER_DAY
+        return rates
+
+    def process_block(self, block, events):
+        """Execute the transitions happening at this {block}.
+
+        {events} are the kinds of the stochastic events happening at this block (see
+        EVENT_KINDS).
+        """
+        # First of all, was any transaction confirmed in this block?
+        self.confirm_sequence(block)
+
+        # Refill once per refill period
+        if block % self.refill_period == 0:
+            self.refill_sequence(block, 0)
+
+        if self.scale_fixed:
+            # We always try to keep the number of expected vaults under watch. We might
+            # not be able to allocate if a CF tx is pending but not yet confirmed.
+            for _ in range(self.wt.vaults_count(), self.num_vaults):
+                try:
+                    self.wt.allocate(self.new_vault_id(), VAULT_AMOUNT, block)
+                except AllocationError as e:
+                    logging.error(
+                        "Not enough funds to allocate all the expected vaults at"
+                        f" block {block}: {str(e)}"
+                    )
+                    break
+        else:
+            if "delegation" in events:
+                self.delegate_sequence(block)
+
+        if "unvault" in events:
+            if self.scale_fixed:
+                self.delegate_sequence(block)
+
+            # generate invalid spend, requires cancel
+            if "invalid_spend" in events:
+                try:
+                    self.cancel(block)
+                except NoVaultToSpend:
+                    logging.info("Failed to Cancel, no vault to spend")
+            # generate valid spend, requires processing
+            else:
+                try:
+                    self.spend(block)
+                except NoVaultToSpend:
+                    logging.info("Failed to Spend, no vault to spend")
+
+        if "catastrophe" in events:
+            try:
+                self.catastrophe_sequence(block)
+            except NoVaultToSpend:
+                logging.info("Failed to Cancel (catastrophe), no vault to spend")
+            # Reboot operation after catastrophe
+            self.refill_sequence(block, self.num_vaults)
+
+    def update_risk(self, block):
+        """Check whether we are under requirements at this {block}, and record the
+        time at risk."""
+        was_risky = self.is_risky
+        self.is_risky = self.wt.vaults_at_risk(block) > 0
+        # If its state changed, record the block
+        if not was_risky and self.is_risky:
+            self.risk_on = block
+        elif was_risky and not self.is_risky:
+            self.wt_risk_time.append((self.risk_on, block))
+
+    def record_block_metrics(self, block):
+        """Populate the data at this {block} for later analysis (see the report()
+        method)."""
+        if self.with_balance:
+            self.balances.record(
+                block,
+                self.wt.balance(),
+                self.required_reserve(block),
+                self.wt.unallocated_balance(),
+            )
+
+        if self.with_op_cost or self.with_cum_op_cost:
+            self.costs.record(block, self.refill_fee, self.cf_fee, self.cancel_fee)
+            self.refill_fee, self.cf_fee, self.cancel_fee = None, None, None
+
+        if self.with_cum_op_cost:
+            self.update_risk(block)
+
+        if self.with_divergence or self.with_risk_status:
+            self.compute_reserve_divergence(block)
+
+        if self.with_fb_coins_dist:
+            if block % 10_000 == 0:
+                self.fb_coins_dist.append(
+                    [block, list(self.wt.fb_coins_dist(block).amounts)]
+                )
+
+        # The oldest pending transactions have the largest confirmation times
+        tx = self.wt.mempool.oldest_cancel()
+        if tx is not None:
+            self.stats.record_cancel_conf_time(block - tx.broadcast_height)
+            if block >= self.wt.mempool.next_expiration():
+                logging.info(
+                    f"Transaction {tx} was not confirmed before the"
+                    " expiration of the locktime!"
+                )
+                raise (
+                    RuntimeError(
+                        "Watchtower failed to confirm cancel"
+                        " transaction in time. All your base are belong"
+                        " to us."
+                    )
+                )
+        tx = self.wt.mempool.oldest_cf()
+        if tx is not None:
+            self.stats.record_cf_conf_time(block - tx.broadcast_height)
+
+    def record_idle_metrics(self, start_block, end_block):
+        """Populate the data for the blocks in [{start_block}, {end_block}[ at once.
+
+        Must only be called when nothing happens in these blocks: no transition, and
+        no pending transaction gets confirmed or replaced. The state of the WT is
+        therefore the same at each of them, only the required reserve changes with
+        the feerates.
+        """
+        if start_block >= end_block:
+            return
+
+        # The pending transactions were pending until the last of these blocks
+        tx = self.wt.mempool.oldest_cancel()
+        if tx is not None:
+            self.stats.record_cancel_conf_time(end_block - 1 - tx.broadcast_height)
+        tx = self.wt.mempool.oldest_cf()
+        if tx is not None:
+            self.stats.record_cf_conf_time(end_block - 1 - tx.broadcast_height)
+        # The required reserve per vault at each of these blocks
+        required = self.dist_totals[
+            start_block - self.start_block : end_block - self.start_block
+        ]
+
+        if self.with_balance:
+            self.balances.record_range(
+                start_block,
+                end_block,
+                self.wt.balance(),
+                self.wt.vaults_count() * required,
+                self.wt.unallocated_balance(),
+            )
+
+        if self.with_op_cost or self.with_cum_op_cost:
+            self.costs.record_range(start_block, end_block, None, None, None)
+
+        if self.with_cum_op_cost:
+            # Whether we are under requirements only depends on the block through
+            # the reserve feerate, only check it again when it changes.
+            fh = self.wt.fee_history
+            reserve_feerate = fh.reserve_feerate[
+                start_block - fh.start_height : end_block - fh.start_height
+            ]
+            changes = np.flatnonzero(reserve_feerate[1:] != reserve_feerate[:-1]) + 1
+            for i in [0] + changes.tolist():
+                self.update_risk(start_block + i)
+
+        reserves = self.wt.reserve_balances()
+        if len(reserves) > 0 and (self.with_divergence or self.with_risk_status):
+            # See compute_reserve_divergence()
+            reserves = np.sort(reserves)
+            if self.with_divergence:
+                self.divergence.record_range(
+                    start_block,
+                    end_block,
+                    (reserves.sum() - len(reserves) * required) / len(reserves),
+                    reserves[0] - required,
+                    reserves[-1] - required,
+                )
+            if self.with_risk_status:
+                # The number of vaults under requirement and the total amount missing
+                n_risky = np.searchsorted(reserves, required, side="left")
+                cum_reserves = np.concatenate(([0], np.cumsum(reserves)))
+                nominal_risk = n_risky * required - cum_reserves[n_risky]
+                risk_coefficient = n_risky / len(reserves) * nominal_risk
+                self.risk_status.record_range(start_block, end_block, risk_coefficient)
+
+    def next_mempool_event(self, block):
+        """The first block after {block} at which something happens to a pending
+        transaction: it gets confirmed, or it's a Cancel that gets replaced or whose
+        locktime expires."""
+        heights = [self.wt.mempool.next_expiration()]
+        for tx in self.wt.mempool:
+            heights.append(self.wt.tx_confirmation_height(tx, block + 1))
+            if isinstance(tx, CancelTx):
+                heights.append(self.wt.cancel_replacement_height(tx, block + 1))
+        return min((h for h in heights if h is not None), default=self.end_block)
+
+    def block_series(self):
+        """The series populated at each block."""
+        return (self.balances, self.divergence, self.costs, self.risk_status)
+
     def run(self, start_block, end_block):
         """Iterate from {start_block} to {end_block}, executing transitions
         according to configuration.
         """
         self.start_block, self.end_block = start_block, end_block
+        for series in self.block_series():
+            series.allocate(start_block, end_block)
         self.refill_fee, self.cf_fee, self.cancel_fee = None, None, None
         # A switch we use to determine whether we are under requirements
-        is_risky = False
+        self.is_risky = False
 
         # At startup allocate as many reserves as we expect to have vaults
         logging.info(
@@ -389,131 +710,190 @@ class Simulation(object):
         )
         self.refill_sequence(start_block, self.num_vaults)
 
-        # For each block in the range, simulate an action affecting the watchtower
-        # (formally described as a sequence of transitions) based on the configured
-        # probabilities and the historical data of the current block.
-        # Then, populate some data at this block for later analysis (see the plot()
-        # method).
-        for block in range(start_block, end_block):
-            # First of all, was any transaction confirmed in this block?
-            self.confirm_sequence(block)
+        # The stochastic events are drawn for the whole range beforehand
+        self.events = events_by_height(
+            *draw_workload(
+                self.prng_seed,
+                start_block,
+                end_block,
+                self.event_rates(),
+                self.invalid_spend_rate,
+            )
+        )
 
-            # Refill once per refill period
-            if block % self.refill_period == 0:
-                self.refill_sequence(block, 0)
+        try:
+            if self.event_driven:
+                self.run_events(start_block, end_block)
+                return
+
+            # For each block in the range, simulate an action affecting the
+            # watchtower (formally described as a sequence of transitions) based on
+            # the events drawn and the historical data of the current block.
+            # Then, populate some data at this block for later analysis (see the
+            # plot() method).
+            for block in range(start_block, end_block):
+                self.process_block(block, self.events.get(block, ()))
+                self.record_block_metrics(block)
+        finally:
+            # Even if the simulation failed, store the data populated until then
+            for series in self.block_series():
+                series.close()
+
+    def run_events(self, start_block, end_block):
+        """Simulate from {start_block} to {end_block} by only going through the
+        blocks at which something happens.
+
+        The heights of the stochastic events are queued along with the refill
+        periods. We go straight from a block to the block of the next event, or to
+        the block at which a pending transaction gets confirmed or replaced if it
+        comes first (these are found from indexes over the feerates, without
+        checking each block). The data for the blocks skipped over is populated at
+        once.
+        """
+        first_refill = math.ceil(start_block / self.refill_period) * self.refill_period
+        heights = list(self.events)
+        heights += range(first_refill, end_block, self.refill_period)
+        if self.with_fb_coins_dist:
+            first_sample = math.ceil(start_block / 10_000) * 10_000
+            heights += range(first_sample, end_block, 10_000)
+        heapq.heapify(heights)
+
+        # The required reserve per vault at each block, for the blocks skipped over
+        _, self.dist_totals = self.wt.coins_dist_totals(start_block, end_block)
+
+        block = start_block
+        while block < end_block:
+            while heights != [] and heights[0] == block:
+                heapq.heappop(heights)
+            self.process_block(block, self.events.get(block, ()))
+            self.record_block_metrics(block)
+
+            next_block = heights[0] if heights != [] else end_block
+            if len(self.wt.mempool) > 0:
+                next_block = min(next_block, self.next_mempool_event(block))
+            self.record_idle_metrics(block + 1, next_block)
+            block = next_block
+
+    def report(self):
+        """Compute metrics about the simulation from the data stored according to
+        configuration. This doesn't plot anything.
+
+        Returns a string containing a "report" about the simulation along with
+        the metrics as a DataFrame.
+        """
+        report = self.report_init
 
-            if self.scale_fixed:
-                # We always try to keep the number of expected vaults under watch. We might
-                # not be able to allocate if a CF tx is pending but not yet confirmed.
-                for _ in range(self.wt.vaults_count(), self.num_vaults):
-                    try:
-                        self.wt.allocate(self.new_vault_id(), VAULT_AMOUNT, block)
-                    except AllocationError as e:
-                        logging.error(
-                            "Not enough funds to allocate all the expected vaults at"
-                            f" block {block}: {str(e)}"
-                        )
-                        break
-            else:
-                # The delegate rate is per day
-                if random.random() < self.delegate_rate / BLOCKS_PER_DAY:
-                    self.delegate_sequence(block)
-
-            # The spend rate is per day
-            if random.random() < self.unvault_rate / BLOCKS_PER_DAY:
-                if self.scale_fixed:
-                    self.delegate_sequence(block)
-
-                # generate invalid spend, requires cancel
-                if random.random() < self.invalid_spend_rate:
-                    try:
-                        self.cancel(block)
-                    except NoVaultToSpend:
-                        logging.info("Failed to Cancel, no vault to spend")
-                # generate valid spend, requires processing
-                else:
-                    try:
-                        self.spend(block)
-                    except NoVaultToSpend:
-                        logging.info("Failed to Spend, no vault to spend")
-
-            # The catastrophe rate is a rate per day
-            if random.random() < self.catastrophe_rate / BLOCKS_PER_DAY:
-                try:
-                    self.catastrophe_sequence(block)
-                except NoVaultToSpend:
-                    logging.info("Failed to Cancel (catastrophe), no vault to spend")
-                # Reboot operation after catastrophe
-                self.refill_sequence(block, self.num_vaults)
-
-            if self.with_balance:
-                self.balances.append(
-                    [
-                        block,
-                        self.wt.balance(),
-                        self.required_reserve(block),
-                        self.wt.unallocated_balance(),
-                    ]
-                )
+        if self.with_balance and len(self.balances) > 0:
+            bal_df = self.balances.to_frame()
+            self.report_df["mean_balance"] = bal_df["Balance"].mean()
 
-            if self.with_op_cost or self.with_cum_op_cost:
-                self.costs.append(
-                    [block, self.refill_fee, self.cf_fee, self.cancel_fee]
-                )
-                self.refill_fee, self.cf_fee, self.cancel_fee = None, None, None
+        costs_df = None
+        if len(self.costs) > 0:
+            costs_df = self.costs.to_frame()
+            report += f"Refill operations: {costs_df['Refill Fee'].count()}\n"
+
+        if self.with_cum_op_cost and costs_df is not None:
+            cumulative_costs_df = costs_df.set_index(["block"]).fillna(0).cumsum()
+            self.report_df["cum_cancel_fee"].loc[0] = cumulative_costs_df[
+                "Cancel Fee"
+            ].iloc[-1]
+            self.report_df["cum_cf_fee"].loc[0] = cumulative_costs_df["CF Fee"].iloc[-1]
+            self.report_df["cum_refill_fee"].loc[0] = cumulative_costs_df[
+                "Refill Fee"
+            ].iloc[-1]
+            self.report_df["cum_ops_cost"].loc[0] = (
+                self.report_df["cum_refill_fee"].loc[0]
+                + self.report_df["cum_cf_fee"].loc[0]
+                + self.report_df["cum_cancel_fee"].loc[0]
+            )
+            report += (
+                "Total cumulative cancel fee cost:"
+                f" {self.report_df['cum_cancel_fee'].loc[0]}\n"
+            )
+            report += (
+                "Total cumulative consolidate-fanout fee cost:"
+                f" {self.report_df['cum_cf_fee'].loc[0]}\n"
+            )
+            report += (
+                "Total cumulative refill fee cost:"
+                f" {self.report_df['cum_refill_fee'].loc[0]}\n"
+            )
+            report += (
+                f"Total cumulative cost: {self.report_df['cum_ops_cost'].loc[0]}\n"
+            )
 
-            if self.with_cum_op_cost:
-                was_risky = is_risky
-                is_risky = any(
-                    self.wt.under_requirement(v, block)
-                    for v in self.wt.list_available_vaults()
+            report += f"Analysis time span: {self.start_block} to {self.end_block}\n"
+            risk_time = 0
+            for risk_on, risk_off in self.wt_risk_time:
+                risk_time += risk_off - risk_on
+            report += f"Total time at risk: {risk_time} blocks\n"
+            self.report_df["time_at_risk"].loc[0] = risk_time
+
+            # What about avg recovery time?
+            recovery_times = []
+            for risk_on, risk_off in self.wt_risk_time:
+                recovery_times.append(risk_off - risk_on)
+            if recovery_times != []:
+                self.report_df["mean_recovery_time"].loc[0] = np.mean(recovery_times)
+                report += (
+                    f"Mean recovery time: {self.report_df['mean_recovery_time'].loc[0]}"
+                    " blocks\n"
+                )
+                self.report_df["median_recovery_time"].loc[0] = np.median(
+                    recovery_times
                 )
-                # If its state changed, record the block
-                if not was_risky and is_risky:
-                    risk_on = block
-                elif was_risky and not is_risky:
-                    risk_off = block
-                    self.wt_risk_time.append((risk_on, risk_off))
-
-            if self.with_divergence or self.with_risk_status:
-                self.compute_reserve_divergence(block)
-
-            if self.with_fb_coins_dist:
-                if block % 10_000 == 0:
-                    self.fb_coins_dist.append([block, self.wt.fb_coins_dist(block)])
-
-            if self.wt.mempool != []:
-                for tx in self.wt.mempool:
-                    if isinstance(tx, CancelTx):
-                        self.report_df["max_cancel_conf_time"].loc[0] = max(
-                            self.report_df["max_cancel_conf_time"].loc[0],
-                            block - tx.broadcast_height,
-                        )
-                        if block - tx.broadcast_height >= self.wt.locktime:
-                            logging.info(
-                                f"Transaction {tx} was not confirmed before the"
-                                " expiration of the locktime!"
-                            )
-                            raise (
-                                RuntimeError(
-                                    "Watchtower failed to confirm cancel"
-                                    " transaction in time. All your base are belong"
-                                    " to us."
-                                )
-                            )
-                    if isinstance(tx, ConsolidateFanoutTx):
-                        self.report_df["max_cf_conf_time"].loc[0] = max(
-                            self.report_df["max_cf_conf_time"].loc[0],
-                            block - tx.broadcast_height,
-                        )
+                report += (
+                    "Median recovery time:"
+                    f" {self.report_df['median_recovery_time'].loc[0]} blocks\n"
+                )
+                self.report_df["max_recovery_time"].loc[0] = max(recovery_times)
+                report += (
+                    f"Max recovery time: {self.report_df['max_recovery_time'].loc[0]}"
+                    " blocks\n"
+                )
+
+        if self.with_risk_status and len(self.risk_status) > 0:
+            risk_status_df = self.risk_status.to_frame()
+            self.report_df["max_risk_coef"] = risk_status_df["risk coefficient"].max()
+
+        # Report confirmation tracking
+        for col in RunStats.__slots__:
+            if getattr(self.stats, col) is not None:
+                self.report_df.loc[0, col] = getattr(self.stats, col)
+        report += (
+            "Max confirmation time for a Cancel Tx:"
+            f" {self.report_df['max_cancel_conf_time'].loc[0]}\n"
+        )
+        report += (
+            "Max confirmation time for a Consolidate-fanout Tx:"
+            f" {self.report_df['max_cf_conf_time'].loc[0]}\n"
+        )
+
+        if self.delegation_failures > 0 or self.delegation_successes > 0:
+            self.report_df["delegation_failure_count"].loc[0] = self.delegation_failures
+            self.report_df["delegation_failure_rate"].loc[0] = (
+                self.delegation_failures
+                / (self.delegation_successes + self.delegation_failures)
+            )
+
+            self.report_df["delegation_failure_rate"].loc[0] = None
+            report += (
+                f"Delegation failures: {self.delegation_failures} /"
+                f" { (self.delegation_successes + self.delegation_failures)}"
+                f" ({(self.delegation_failures /  (self.delegation_successes + self.delegation_failures) )* 100}%)\n"
+            )
+
+        return (report, self.report_df)
 
     def plot(self, output=None, show=False):
         """Plot info about the simulation stored according to configuration.
         If {output} is set, will write the plot image to this file.
 
-        Returns a string containing a "report" about the simulation.
+        Returns a string containing a "report" about the simulation (see `report`).
         """
-        report = self.report_init
+        # Matplotlib is slow to import, only do so when we actually plot.
+        from matplotlib import pyplot as plt
+
         plt.style.use(["plot_style.txt"])
 
         subplots_len = sum(
@@ -528,30 +908,31 @@ class Simulation(object):
                 self.with_fb_coins_dist,
             ]
         )
+        if subplots_len == 0:
+            logging.info("No plot type enabled, nothing to plot.")
+            return self.report()
         figure, axes = plt.subplots(
-            subplots_len, 1, sharex=True, figsize=(5.4, subplots_len * 3.9)
+            subplots_len,
+            1,
+            sharex=True,
+            figsize=(5.4, subplots_len * 3.9),
+            squeeze=False,
         )
+        axes = axes[:, 0]
         plot_num = 0
 
         # Plot WT balance vs total required reserve
-        if self.with_balance and self.balances != []:
-            bal_df = DataFrame(
-                self.balances,
-                columns=["block", "Balance", "Required Reserve", "Unallocated Balance"],
-            )
+        if self.with_balance and len(self.balances) > 0:
+            bal_df = self.balances.to_frame()
             bal_df.set_index(["block"], inplace=True)
             bal_df.plot(ax=axes[plot_num], title="WT Balance", legend=True)
             axes[plot_num].set_xlabel("Block", labelpad=15)
             axes[plot_num].set_ylabel("Satoshis", labelpad=15)
-            self.report_df["mean_balance"] = bal_df["Balance"].mean()
             plot_num += 1
 
         costs_df = None
-        if self.costs != []:
-            costs_df = DataFrame(
-                self.costs, columns=["block", "Refill Fee", "CF Fee", "Cancel Fee"]
-            )
-            report += f"Refill operations: {costs_df['Refill Fee'].count()}\n"
+        if len(self.costs) > 0:
+            costs_df = self.costs.to_frame()
 
         # Plot refill amount vs block, operating expense vs block
         if self.with_op_cost and costs_df is not None:
@@ -588,9 +969,7 @@ class Simulation(object):
 
         # Plot cumulative operating costs (CF, Cancel, Spend)
         if self.with_cum_op_cost and costs_df is not None:
-            cumulative_costs_df = costs_df
-            cumulative_costs_df.set_index(["block"], inplace=True)
-            cumulative_costs_df = cumulative_costs_df.fillna(0).cumsum()
+            cumulative_costs_df = costs_df.set_index(["block"]).fillna(0).cumsum()
             cumulative_costs_df.plot.line(
                 ax=axes[plot_num],
                 color={"Refill Fee": "r", "CF Fee": "g", "Cancel Fee": "b"},
@@ -599,77 +978,17 @@ class Simulation(object):
             axes[plot_num].set_title("Cumulative Operating Costs")
             axes[plot_num].set_ylabel("Satoshis", labelpad=15)
             axes[plot_num].set_xlabel("Block", labelpad=15)
-            self.report_df["cum_cancel_fee"].loc[0] = cumulative_costs_df[
-                "Cancel Fee"
-            ].iloc[-1]
-            self.report_df["cum_cf_fee"].loc[0] = cumulative_costs_df["CF Fee"].iloc[-1]
-            self.report_df["cum_refill_fee"].loc[0] = cumulative_costs_df[
-                "Refill Fee"
-            ].iloc[-1]
-            self.report_df["cum_ops_cost"].loc[0] = (
-                self.report_df["cum_refill_fee"].loc[0]
-                + self.report_df["cum_cf_fee"].loc[0]
-                + self.report_df["cum_cancel_fee"].loc[0]
-            )
-            report += (
-                "Total cumulative cancel fee cost:"
-                f" {self.report_df['cum_cancel_fee'].loc[0]}\n"
-            )
-            report += (
-                "Total cumulative consolidate-fanout fee cost:"
-                f" {self.report_df['cum_cf_fee'].loc[0]}\n"
-            )
-            report += (
-                "Total cumulative refill fee cost:"
-                f" {self.report_df['cum_refill_fee'].loc[0]}\n"
-            )
-            report += (
-                f"Total cumulative cost: {self.report_df['cum_ops_cost'].loc[0]}\n"
-            )
 
             # Highlight the plot with areas that show when the WT is at risk due to at least one
             # insufficient vault fee-reserve
-            for (risk_on, risk_off) in self.wt_risk_time:
+            for risk_on, risk_off in self.wt_risk_time:
                 axes[plot_num].axvspan(risk_off, risk_on, color="red", alpha=0.25)
 
-            report += f"Analysis time span: {self.start_block} to {self.end_block}\n"
-            risk_time = 0
-            for (risk_on, risk_off) in self.wt_risk_time:
-                risk_time += risk_off - risk_on
-            report += f"Total time at risk: {risk_time} blocks\n"
-            self.report_df["time_at_risk"].loc[0] = risk_time
-
-            # What about avg recovery time?
-            recovery_times = []
-            for (risk_on, risk_off) in self.wt_risk_time:
-                recovery_times.append(risk_off - risk_on)
-            if recovery_times != []:
-                self.report_df["mean_recovery_time"].loc[0] = np.mean(recovery_times)
-                report += (
-                    f"Mean recovery time: {self.report_df['mean_recovery_time'].loc[0]}"
-                    " blocks\n"
-                )
-                self.report_df["median_recovery_time"].loc[0] = np.median(
-                    recovery_times
-                )
-                report += (
-                    "Median recovery time:"
-                    f" {self.report_df['median_recovery_time'].loc[0]} blocks\n"
-                )
-                self.report_df["max_recovery_time"].loc[0] = max(recovery_times)
-                report += (
-                    f"Max recovery time: {self.report_df['max_recovery_time'].loc[0]}"
-                    " blocks\n"
-                )
-
             plot_num += 1
 
         # Plot vault reserves divergence
-        if self.with_divergence and self.divergence != []:
-            div_df = DataFrame(
-                self.divergence,
-                columns=["Block", "MeanDivergence", "MinDivergence", "MaxDivergence"],
-            )
+        if self.with_divergence and len(self.divergence) > 0:
+            div_df = self.divergence.to_frame(block_column="Block")
             div_df.set_index("Block", inplace=True)
             div_df["MeanDivergence"].plot(
                 ax=axes[plot_num], label="Mean Divergence", legend=True
@@ -686,11 +1005,8 @@ class Simulation(object):
             plot_num += 1
 
         # Plot WT risk status
-        if self.with_risk_status and self.risk_status != []:
-            risk_status_df = DataFrame(
-                self.risk_status, columns=["block", "risk coefficient"]
-            )
-            self.report_df["max_risk_coef"] = risk_status_df["risk coefficient"].max()
+        if self.with_risk_status and len(self.risk_status) > 0:
+            risk_status_df = self.risk_status.to_frame()
             risk_status_df.set_index(["block"], inplace=True)
             risk_status_df.plot(ax=axes[plot_num])
             axes[plot_num].set_title("Risk Coefficient, $\Omega$")
@@ -742,44 +1058,24 @@ class Simulation(object):
 
             plot_num += 1
 
-        # Report confirmation tracking
-        report += (
-            "Max confirmation time for a Cancel Tx:"
-            f" {self.report_df['max_cancel_conf_time'].loc[0]}\n"
-        )
-        report += (
-            "Max confirmation time for a Consolidate-fanout Tx:"
-            f" {self.report_df['max_cf_conf_time'].loc[0]}\n"
-        )
-
         if output is not None:
             plt.savefig(f"{output}.png")
 
         if show:
             plt.show()
 
-        if self.delegation_failures > 0 or self.delegation_successes > 0:
-            self.report_df["delegation_failure_count"].loc[0] = self.delegation_failures
-            self.report_df["delegation_failure_rate"].loc[
-                0
-            ] = self.delegation_failures / (
-                self.delegation_successes + self.delegation_failures
-            )
-
-            self.report_df["delegation_failure_rate"].loc[0] = None
-            report += (
-                f"Delegation failures: {self.delegation_failures} /"
-                f" { (self.delegation_successes + self.delegation_failures)}"
-                f" ({(self.delegation_failures /  (self.delegation_successes + self.delegation_failures) )* 100}%)\n"
-            )
-
-        return (report, self.report_df)
+        return self.report()
 
     def plot_fee_history(self, start_block, end_block, output=None, show=False):
+        from matplotlib import pyplot as plt
 
         plt.style.use(["plot_style.txt"])
         fig, axes = plt.subplots(1, 1, figsize=(5.4, 3.9))
-        self.wt.hist_df["mean_feerate"][start_block:end_block].plot(color="black")
+        fh = self.wt.fee_history
+        start, end = start_block - fh.start_height, end_block - fh.start_height
+        Series(fh.mean_feerate[start:end], index=range(start_block, end_block)).plot(
+            color="black"
+        )
         axes.set_ylabel("Satoshis per Weight Unit", labelpad=15)
         axes.set_xlabel("Block", labelpad=15)
 
@@ -790,6 +1086,8 @@ class Simulation(object):
             plt.show()
 
     def plot_frpv(self, start_block, end_block, output=None, show=False):
+        from matplotlib import pyplot as plt
+
         plt.style.use(["plot_style.txt"])
         frpv = []
         for block in range(start_block, end_block):
@@ -812,6 +1110,8 @@ class Simulation(object):
     def plot_fee_estimate(
         self, comp_strat, start_block, end_block, output=None, show=False
     ):
+        from matplotlib import pyplot as plt
+
         plt.style.use(["plot_style.txt"])
         estimates = []
         for block in range(start_block, end_block):
@@ -5,13 +5,18 @@ TODO:
 * Make good documentation 
 """
 
-import itertools
+import bisect
+import heapq
 import logging
 import math
-
-from enum import Enum
-from pandas import read_csv
-from transactions import CancelTx, ConsolidateFanoutTx
+import numpy as np
+import os
+import random
+
+from collections import namedtuple
+from enum import IntEnum
+from fee_history import FeeHistory, FirstBelowIndex, load_fee_history
+from transactions import CancelTx, ConsolidateFanoutTx, Mempool
 from utils import (
     P2WPKH_INPUT_SIZE,
     P2WPKH_OUTPUT_SIZE,
@@ -22,6 +27,10 @@ from utils import (
     MIN_BUMP_WORST_CASE,
 )
 
+# Check the running balances against their recomputation from all the coins each
+# time they are queried. This is slow, only meant for debugging.
+CHECK_BALANCES = bool(int(os.getenv("CHECK_BALANCES", 0)))
+
 
 class CfError(RuntimeError):
     """An error arising during the creation of the Consolidate-Fanout tx"""
@@ -47,7 +56,7 @@ class CoinSelectionError(RuntimeError):
         self.message = message
 
 
-class ProcessingState(Enum):
+class ProcessingState(IntEnum):
     """The state of feebump coin"""
 
     UNPROCESSED = 0
@@ -55,7 +64,7 @@ class ProcessingState(Enum):
     CONFIRMED = 2
 
 
-class VaultState(Enum):
+class VaultState(IntEnum):
     """Whether a vault is being spent or canceled"""
 
     READY = 0
@@ -66,14 +75,17 @@ class VaultState(Enum):
 class Vault:
     """A vault the WT is watching for."""
 
+    __slots__ = ("id", "amount", "fb_coins", "reserve_amount", "status", "available")
+
     def __init__(self, _id, amount, status=VaultState.READY):
         assert isinstance(amount, int) and isinstance(_id, int)
         self.id = _id
         self.amount = amount
-        # The feebump coins that were allocated to this vault
+        # The feebump coins that were allocated to this vault, and their total value
         self.fb_coins = {}
+        self.reserve_amount = 0
         # status used to track whether vault should be considered during other state transitions
-        self.status = status
+        self.set_status(status)
 
     def __repr__(self):
         return f"Vault(id={self.id}, amount={self.amount}, coins={self.fb_coins})"
@@ -85,35 +97,45 @@ class Vault:
         assert coin.id not in self.fb_coins
         assert coin.is_confirmed()
         self.fb_coins[coin.id] = coin
+        self.reserve_amount += coin.amount
 
     def deallocate_coin(self, coin):
         del self.fb_coins[coin.id]
+        self.reserve_amount -= coin.amount
 
     def deallocate_all_coins(self):
         self.fb_coins = {}
+        self.reserve_amount = 0
 
     def reserve_balance(self):
-        return sum(c.amount for c in self.fb_coins.values())
+        if CHECK_BALANCES:
+            assert self.reserve_amount == sum(c.amount for c in self.fb_coins.values())
+        return self.reserve_amount
 
     def set_status(self, status):
         assert isinstance(status, VaultState)
         self.status = status
+        self.available = status == VaultState.READY
 
     def is_available(self):
-        return self.status == VaultState.READY
+        return self.available
 
 
 class FeebumpCoin:
     """A coin in the WT wallet that will eventually be used to feebump."""
 
+    __slots__ = ("id", "amount", "processing_state", "fan_block", "confirmed")
+
     def __init__(
         self, _id, amount, processing_state=ProcessingState.UNPROCESSED, fan_block=None
     ):
-        assert fan_block is None or processing_state == ProcessingState.CONFIRMED
+        # A coin has a fan block if and only if it's confirmed
+        assert (fan_block is None) != (processing_state == ProcessingState.CONFIRMED)
         assert isinstance(amount, int) and isinstance(_id, int)
         self.id = _id
         self.amount = amount
         self.processing_state = processing_state
+        self.confirmed = processing_state == ProcessingState.CONFIRMED
         # If confirmed, the block at which it was created by the CF tx,
         # tracked because of cf_coin_selec_1
         self.fan_block = fan_block
@@ -121,7 +143,7 @@ class FeebumpCoin:
     def __repr__(self):
         return (
             f"Coin(id={self.id}, amount={self.amount}, fan_block={self.fan_block},"
-            f" state={self.processing_state})"
+            f" state={self.processing_state.name})"
         )
 
     def __lt__(a, b):
@@ -129,27 +151,20 @@ class FeebumpCoin:
 
     def is_confirmed(self):
         """Whether this coin was fanned out and confirmed"""
-        if self.processing_state == ProcessingState.CONFIRMED:
-            assert self.fan_block is not None
-            return True
-        return False
+        return self.confirmed
 
     def is_unconfirmed(self):
         """Whether this coin was fanned out but not yet confirmed"""
-        if self.processing_state == ProcessingState.PENDING:
-            assert self.fan_block is None
-            return True
-        return False
+        return self.processing_state == ProcessingState.PENDING
 
     def is_unprocessed(self):
         """Whether this coin is a new refill coin"""
         return self.processing_state == ProcessingState.UNPROCESSED
 
-    def increase_amount(self, value_increase):
-        self.amount += value_increase
-
     def confirm(self, height):
+        assert height is not None
         self.processing_state = ProcessingState.CONFIRMED
+        self.confirmed = True
         self.fan_block = height
 
 
@@ -169,8 +184,340 @@ def coins_dist_rec(value, min, feerate):
     )
 
 
+def coins_dist_rec_totals(value, min, feerate):
+    """The sum of the coin values `coins_dist_rec` creates, computed at once for
+    arrays of {value}, {min} and {feerate}.
+    """
+    value = np.asarray(value, dtype=np.int64)
+    min = np.asarray(min, dtype=np.int64)
+    totals = np.zeros(len(value), dtype=np.int64)
+    # The indexes of the distributions we are still creating coins for
+    pending = np.arange(len(value))
+    while len(pending) > 0:
+        done = value <= min
+        totals[pending[done]] += min[done]
+        pending, value, min, feerate = (
+            pending[~done],
+            value[~done],
+            min[~done],
+            feerate[~done],
+        )
+        totals[pending] += np.ceil(value / 2 + P2WPKH_INPUT_SIZE * feerate).astype(
+            np.int64
+        )
+        value = np.ceil(value / 2).astype(np.int64)
+    return totals
+
+
+# A coin amount distribution, as an immutable tuple of amounts along with their sum
+CoinsDist = namedtuple("CoinsDist", ["amounts", "total"])
+
+
+def coins_dist(amounts):
+    amounts = tuple(amounts)
+    return CoinsDist(amounts, sum(amounts))
+
+
+# How many distinct coin distributions are remembered by the state machine
+COINS_DIST_CACHE_SIZE = 1024
+
+# How many sets of coins the Cancel coin selection may go through before settling
+# for a greedy selection. It always goes through all of them for up to 16 coins.
+CANCEL_COIN_SELEC_BUDGET = 2**17
+# The margin on the bounds of the Cancel coin selection search, for the rounding
+# of the effective values.
+EFFECTIVE_VALUE_TOLERANCE = 1e-6
+
+# The number of bits needed to represent any amount, in sats (21M BTC < 2**51)
+AMOUNT_BITS = 51
+
+
+def min_overpayment_selection(
+    amounts, txin_cost, needed_fee, best, budget=CANCEL_COIN_SELEC_BUDGET
+):
+    """Search the set of at least two coins among these {amounts} (in increasing
+    order) with the smallest effective value above {needed_fee}, or with the same
+    value but fewer coins, that is better than the {best} (effective value, number
+    of coins) we already have.
+
+    This is a depth-first branch-and-bound search through the sets of coins in
+    lexicographic order, so that among equally good sets we get the same as going
+    through `itertools.combinations` for each size. If it didn't complete within
+    the {budget} of sets, we also consider a greedy selection.
+
+    Returns the indexes of the coins in the set, None if none is better.
+    """
+    n = len(amounts)
+    tol = EFFECTIVE_VALUE_TOLERANCE
+    # The coins worth less than their inclusion cost come first, and the ones
+    # worth more than it last.
+    n_neg = bisect.bisect_left(amounts, txin_cost)
+    n_nonpos = bisect.bisect_right(amounts, txin_cost)
+    # From each index on: the value and number of the coins worth more than their
+    # cost, and the sum of the effective values of those worth less.
+    pos_values, pos_counts, neg_ev = [0] * (n + 1), [0] * (n + 1), [0] * (n + 1)
+    for i in reversed(range(n)):
+        pos_values[i], pos_counts[i], neg_ev[i] = (
+            pos_values[i + 1],
+            pos_counts[i + 1],
+            neg_ev[i + 1],
+        )
+        if i >= n_nonpos:
+            pos_values[i] += amounts[i]
+            pos_counts[i] += 1
+        elif i < n_neg:
+            neg_ev[i] += amounts[i] - txin_cost
+
+    best_ev, best_len = best
+    best_set = None
+    selected = []
+    visited = 0
+
+    def search(start, value):
+        nonlocal best_ev, best_len, best_set, visited
+        for i in range(start, n):
+            if visited >= budget:
+                return
+            visited += 1
+            cand_value = value + amounts[i]
+            cand_len = len(selected) + 1
+            cand_ev = cand_value - txin_cost * cand_len
+            # Past the coins worth less than their cost, adding a larger coin only
+            # increases the effective value.
+            if i >= n_neg and cand_ev > best_ev + tol:
+                return
+            # We can't meet the fee even by adding all the coins that increase the
+            # effective value.
+            max_ev = (
+                cand_value
+                + pos_values[i + 1]
+                - txin_cost * (cand_len + pos_counts[i + 1])
+            )
+            if max_ev < needed_fee - tol:
+                continue
+
+            selected.append(i)
+            if cand_len >= 2 and cand_ev >= needed_fee:
+                if cand_ev < best_ev or (cand_ev == best_ev and cand_len < best_len):
+                    best_ev, best_len, best_set = cand_ev, cand_len, tuple(selected)
+                # Only adding coins worth less than their cost could improve it.
+                if i + 1 >= n_neg:
+                    selected.pop()
+                    continue
+            if cand_ev + neg_ev[i + 1] <= best_ev + tol:
+                search(i + 1, cand_value)
+            selected.pop()
+
+    search(0, 0)
+
+    if visited >= budget:
+        logging.debug(
+            f"        Cancel coin selection search budget exhausted with {n} coins,"
+            " considering a greedy selection."
+        )
+        # Take the largest coins until we meet the fee, then replace the last one
+        # with the smallest coin that still meets it.
+        greedy, value = [], 0
+        for i in reversed(range(n_nonpos, n)):
+            greedy.append(i)
+            value += amounts[i]
+            if value - txin_cost * len(greedy) >= needed_fee:
+                last = greedy.pop()
+                value -= amounts[last]
+                for j in range(last + 1):
+                    if value + amounts[j] - txin_cost * (len(greedy) + 1) >= needed_fee:
+                        greedy.append(j)
+                        value += amounts[j]
+                        break
+                cand_ev = value - txin_cost * len(greedy)
+                if len(greedy) >= 2 and (
+                    cand_ev < best_ev or (cand_ev == best_ev and len(greedy) < best_len)
+                ):
+                    best_set = tuple(sorted(greedy))
+                break
+
+    return best_set
+
+
+def first_above(start, step, limit):
+    """The first i >= 0 for which {start} + i * {step} is above {limit}, None if
+    there is none."""
+    if start > limit:
+        return 0
+    if step <= 0:
+        return None
+    return (limit - start) // step + 1
+
+
+def first_condition(conditions):
+    """The first i at which any of these (start, step, limit) conditions holds (see
+    `first_above`), along with the index of the first condition holding at i."""
+    firsts = [first_above(*cond) for cond in conditions]
+    first = min(i for i in firsts if i is not None)
+    return first, firsts.index(first)
+
+
+def cf_distributions_count(budget, cf_size, cf_fee, reserve, bonus):
+    """How many reserve and bonus distributions a CF tx of {cf_size} paying {cf_fee}
+    without any output can create with a {budget} of inputs value, and whether it
+    needs a change output.
+
+    The CF tx adds a reserve then a bonus distribution in turn until it can't
+    afford the value of the next one, the fees for it, or it would get larger than
+    MAX_TX_SIZE. In this last case it adds a change output instead. Once it can't
+    afford a bonus it only adds reserves. Each of these conditions is linear in the
+    number of distributions, so we compute when the first of them is met instead
+    of adding them one by one.
+
+    {reserve} and {bonus} are the (cost, size, fees) of a distribution, the cost
+    being the total value of the coins and the fees. Returns the number of reserve
+    distributions, of bonus distributions, and whether a change output is needed.
+    """
+    (rese_cost, rese_size, rese_fees), (bonu_cost, bonu_size, bonu_fees) = (
+        reserve,
+        bonus,
+    )
+    pair_cost, pair_size = rese_cost + bonu_cost, rese_size + bonu_size
+    pair_fees = rese_fees + bonu_fees
+    # Don't create a new set of outputs if we can't afford its value, if we can't
+    # pay the fees for it, or if it would make the tx too large. The conditions
+    # before adding the i-th reserve distribution then the i-th bonus one.
+    n_pairs, reserve_stop = first_condition(
+        [
+            (rese_cost, pair_cost, budget),
+            (rese_cost + cf_fee, pair_cost + pair_fees, budget - 1),
+            (cf_size + rese_size, pair_size, MAX_TX_SIZE),
+        ]
+    )
+    n_bonus_pairs, bonus_stop = first_condition(
+        [
+            (pair_cost, pair_cost, budget),
+            (pair_cost + cf_fee + rese_fees, pair_cost + pair_fees, budget - 1),
+            (cf_size + pair_size, pair_size, MAX_TX_SIZE),
+        ]
+    )
+    if n_pairs <= n_bonus_pairs:
+        return n_pairs, n_pairs, reserve_stop == 2
+    if bonus_stop > 0:
+        return n_bonus_pairs + 1, n_bonus_pairs, bonus_stop == 2
+
+    # We can't afford a bonus anymore, only add reserves from now on.
+    consumed = n_bonus_pairs * pair_cost + rese_cost
+    cf_size += n_bonus_pairs * pair_size + rese_size
+    cf_fee += n_bonus_pairs * pair_fees + rese_fees
+    n_reserves, reserve_stop = first_condition(
+        [
+            (consumed + rese_cost, rese_cost, budget),
+            (consumed + rese_cost + cf_fee, rese_cost + rese_fees, budget - 1),
+            (cf_size + rese_size, rese_size, MAX_TX_SIZE),
+        ]
+    )
+    return n_bonus_pairs + 1 + n_reserves, n_bonus_pairs, reserve_stop == 2
+
+
+class AmountIndex:
+    """A set of (amount, position) pairs, to find the lowest position among the
+    pairs whose amount is in a given range in logarithmic time.
+
+    It is a segment tree over all the possible amounts, storing the lowest position
+    under each node. Only the non-empty nodes are stored. The positions of each
+    amount are kept sorted in its leaf.
+    """
+
+    def __init__(self, bits=AMOUNT_BITS):
+        # The node i covers the children 2i and 2i+1, the leaves start at {size}.
+        self.size = 1 << bits
+        self.mins = {}
+        # The sorted positions for each amount
+        self.leaves = {}
+
+    def update(self, node, position):
+        """Set the lowest position under {node} to {position} (None if empty) and
+        propagate it to its ancestors, until one of them doesn't change."""
+        while node > 0:
+            if self.mins.get(node) == position:
+                return
+            if position is None:
+                del self.mins[node]
+            else:
+                self.mins[node] = position
+            sibling = self.mins.get(node ^ 1)
+            if position is None or (sibling is not None and sibling < position):
+                position = sibling
+            node >>= 1
+
+    def add(self, amount, position):
+        positions = self.leaves.setdefault(amount, [])
+        bisect.insort(positions, position)
+        self.update(self.size + amount, positions[0])
+
+    def remove(self, amount, position):
+        positions = self.leaves[amount]
+        i = bisect.bisect_left(positions, position)
+        assert positions[i] == position
+        del positions[i]
+        if positions == []:
+            del self.leaves[amount]
+            self.update(self.size + amount, None)
+        else:
+            self.update(self.size + amount, positions[0])
+
+    def cover(self, min_amount, max_amount):
+        """The non-empty nodes covering exactly the amounts between {min_amount}
+        and {max_amount}."""
+        lo = self.size + max(math.ceil(min_amount), 0)
+        hi = self.size + math.floor(min(max_amount, self.size - 1)) + 1
+        nodes = []
+        while lo < hi:
+            if lo & 1:
+                nodes.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                nodes.append(hi)
+            lo >>= 1
+            hi >>= 1
+        return [node for node in nodes if node in self.mins]
+
+    def first_position(self, min_amount, max_amount):
+        """The lowest position with an amount between {min_amount} and {max_amount},
+        None if there is none."""
+        return min(
+            (self.mins[node] for node in self.cover(min_amount, max_amount)),
+            default=None,
+        )
+
+    def positions(self, min_amount, max_amount):
+        """The positions with an amount between {min_amount} and {max_amount}, in
+        increasing order."""
+        # Merge the subtrees, expanding the node with the lowest position first
+        heap = [
+            (self.mins[node], node, 0) for node in self.cover(min_amount, max_amount)
+        ]
+        heapq.heapify(heap)
+        positions = []
+        while heap != []:
+            position, node, i = heapq.heappop(heap)
+            if node >= self.size:
+                positions.append(position)
+                leaf = self.leaves[node - self.size]
+                if i + 1 < len(leaf):
+                    heapq.heappush(heap, (leaf[i + 1], node, i + 1))
+                continue
+            for child in (2 * node, 2 * node + 1):
+                if child in self.mins:
+                    heapq.heappush(heap, (self.mins[child], child, 0))
+        return positions
+
+
 class CoinPool:
-    """A set of feebump coins that the WT operates."""
+    """A set of feebump coins that the WT operates.
+
+    The pool keeps track of its coins by processing state, and of the coins
+    available for allocation (confirmed and unallocated) by amount, so that we
+    don't need to go through all the coins when looking for some. The coins are
+    otherwise always considered in the order they were added to the pool.
+    """
 
     def __init__(self):
         # A map from the coin id to the coin
@@ -179,6 +526,20 @@ class CoinPool:
         self.allocation_map = {}
         # A counter to generate unique ids for coins
         self.coin_id = 0
+        # The total value of all the coins, and of the unallocated ones
+        self.total_amount = 0
+        self.unallocated_amount = 0
+        # A map from the coin id to the coin, for each processing state
+        self.coins_by_state = {state: {} for state in ProcessingState}
+        # The coins are ordered by the time they were added to the pool. A map
+        # from the coin id to its position in this order, and the reverse map.
+        self.coins_seq = {}
+        self.coins_by_seq = {}
+        self.seq = 0
+        # The positions of the confirmed and unallocated coins, by amount
+        self.unallocated_index = AmountIndex()
+        # The ids of the vaults being spent or canceled
+        self.unready_vaults = set()
 
     def new_coin_id(self):
         self.coin_id += 1
@@ -190,31 +551,106 @@ class CoinPool:
     def list_coins(self):
         return self.coins.values()
 
+    def coins_in_state(self, processing_state):
+        """The coins currently in this processing state."""
+        return self.coins_by_state[processing_state].values()
+
     def balance(self):
-        return sum(c.amount for c in self.coins.values())
+        if CHECK_BALANCES:
+            assert self.total_amount == sum(c.amount for c in self.coins.values())
+        return self.total_amount
+
+    def unallocated_balance(self):
+        """The total value of the coins not allocated to any vault, whatever their
+        processing state."""
+        if CHECK_BALANCES:
+            assert self.unallocated_amount == sum(
+                c.amount for c in self.coins.values() if not self.is_allocated(c)
+            )
+        return self.unallocated_amount
 
     def is_allocated(self, coin):
         return coin.id in self.allocation_map
 
+    def set_vault_status(self, vault_id, status):
+        """Track the status of the vaults, for `cf_candidates`."""
+        if status == VaultState.READY:
+            self.unready_vaults.discard(vault_id)
+        else:
+            self.unready_vaults.add(vault_id)
+
+    def forget_vault(self, vault_id):
+        """Stop tracking the status of a vault once it was removed."""
+        self.unready_vaults.discard(vault_id)
+
+    def cf_candidates(self, states, dust_thresh=None):
+        """The coins in any of these processing {states} that a CF tx may consume:
+        those not allocated to a vault being spent or canceled. If {dust_thresh} is
+        set, only the confirmed coins worth less than it.
+
+        They are ordered by state, then by the time they entered it.
+        """
+        coins = []
+        for state in states:
+            for coin in self.coins_by_state[state].values():
+                if self.allocation_map.get(coin.id) in self.unready_vaults:
+                    continue
+                if (
+                    dust_thresh is not None
+                    and state == ProcessingState.CONFIRMED
+                    and not coin.amount < dust_thresh
+                ):
+                    continue
+                coins.append(coin)
+        return coins
+
     def coin_allocation(self, coin):
         return self.allocation_map[coin.id]
 
-    def unallocated_coins(self):
-        """Return coins that were fanned out but not yet allocated."""
+    def index_unallocated(self, coin):
+        self.unallocated_index.add(coin.amount, self.coins_seq[coin.id])
+
+    def unindex_unallocated(self, coin):
+        self.unallocated_index.remove(coin.amount, self.coins_seq[coin.id])
+
+    def unallocated_coins(self, min_amount=0, max_amount=math.inf):
+        """Return coins that were fanned out but not yet allocated. Only those worth
+        between {min_amount} and {max_amount} if set."""
         return [
-            c
-            for c in self.coins.values()
-            if c.is_confirmed() and c.id not in self.allocation_map
+            self.coins_by_seq[seq]
+            for seq in self.unallocated_index.positions(min_amount, max_amount)
         ]
 
+    def first_unallocated_coin(self, min_amount, max_amount):
+        """Return the first unallocated coin worth between {min_amount} and
+        {max_amount} (in the same order as `unallocated_coins`), or None."""
+        seq = self.unallocated_index.first_position(min_amount, max_amount)
+        return self.coins_by_seq[seq] if seq is not None else None
+
     def allocate_coin(self, coin, vault):
         assert isinstance(coin, FeebumpCoin) and isinstance(vault, Vault)
         assert coin.id not in self.allocation_map
         assert coin.is_confirmed()
         self.allocation_map[coin.id] = vault.id
+        self.unallocated_amount -= coin.amount
+        self.unindex_unallocated(coin)
 
     def deallocate_coin(self, coin):
         del self.allocation_map[coin.id]
+        self.unallocated_amount += coin.amount
+        self.index_unallocated(coin)
+
+    def index_unallocated_coins(self, coins):
+        """Same as `index_unallocated` for each of these coins."""
+        for coin in coins:
+            self.index_unallocated(coin)
+
+    def deallocate_coins(self, coins):
+        """Deallocate all these coins in a single pass."""
+        for coin in coins:
+            del self.allocation_map[coin.id]
+        self.unallocated_amount += sum(c.amount for c in coins)
+        self.index_unallocated_coins(coins)
 
     def add_coin(
         self,
@@ -225,21 +661,404 @@ class CoinPool:
         coin_id=None,
     ):
         coin_id = coin_id if coin_id is not None else self.new_coin_id()
-        self.coins[coin_id] = FeebumpCoin(coin_id, amount, processing_state, fan_block)
+        coin = FeebumpCoin(coin_id, amount, processing_state, fan_block)
+        self.coins[coin_id] = coin
+        self.coins_by_state[processing_state][coin_id] = coin
+        self.seq += 1
+        self.coins_seq[coin_id] = self.seq
+        self.coins_by_seq[self.seq] = coin
+        self.total_amount += amount
         if allocated_vault_id is not None:
             assert isinstance(allocated_vault_id, int)
             self.allocation_map[coin_id] = allocated_vault_id
-        return self.coins[coin_id]
+        else:
+            self.unallocated_amount += amount
+            if coin.is_confirmed():
+                self.index_unallocated(coin)
+        return coin
+
+    def add_coins(self, amounts, processing_state=ProcessingState.UNPROCESSED):
+        """Add unallocated coins worth these {amounts} in a single pass. Same as
+        calling `add_coin` for each amount, in order, but they can't be confirmed."""
+        assert processing_state != ProcessingState.CONFIRMED
+        coins = []
+        coins_in_state = self.coins_by_state[processing_state]
+        for amount in amounts:
+            self.coin_id += 1
+            self.seq += 1
+            coin = FeebumpCoin(self.coin_id, amount, processing_state)
+            self.coins[coin.id] = coin
+            coins_in_state[coin.id] = coin
+            self.coins_seq[coin.id] = self.seq
+            self.coins_by_seq[self.seq] = coin
+            coins.append(coin)
+        added_amount = sum(amounts)
+        self.total_amount += added_amount
+        self.unallocated_amount += added_amount
+        return coins
 
     def confirm_coin(self, coin, fan_height):
-        self.coins[coin.id].confirm(fan_height)
+        coin = self.coins[coin.id]
+        assert not self.is_allocated(coin)
+        del self.coins_by_state[coin.processing_state][coin.id]
+        coin.confirm(fan_height)
+        self.coins_by_state[coin.processing_state][coin.id] = coin
+        self.index_unallocated(coin)
+
+    def confirm_coins(self, coins, fan_height):
+        """Confirm all these unconfirmed coins in a single pass."""
+        coins = [self.coins[c.id] for c in coins]
+        assert not any(self.is_allocated(c) for c in coins)
+        pending = self.coins_by_state[ProcessingState.PENDING]
+        confirmed = self.coins_by_state[ProcessingState.CONFIRMED]
+        for coin in coins:
+            del pending[coin.id]
+            coin.confirm(fan_height)
+            confirmed[coin.id] = coin
+        self.index_unallocated_coins(coins)
 
     def remove_coin(self, coin):
         """Remove a coin from the pool by value"""
         if self.is_allocated(coin):
-            self.deallocate_coin(coin)
+            del self.allocation_map[coin.id]
+        else:
+            self.unallocated_amount -= coin.amount
+            if coin.is_confirmed():
+                self.unindex_unallocated(coin)
+        self.total_amount -= coin.amount
+        del self.coins_by_state[coin.processing_state][coin.id]
+        del self.coins_by_seq[self.coins_seq.pop(coin.id)]
         del self.coins[coin.id]
 
+    def remove_coins(self, coins):
+        """Remove all these coins from the pool in a single pass."""
+        for coin in coins:
+            seq = self.coins_seq.pop(coin.id)
+            if self.is_allocated(coin):
+                del self.allocation_map[coin.id]
+            else:
+                self.unallocated_amount -= coin.amount
+                if coin.is_confirmed():
+                    self.unallocated_index.remove(coin.amount, seq)
+            self.total_amount -= coin.amount
+            del self.coins_by_state[coin.processing_state][coin.id]
+            del self.coins_by_seq[seq]
+            del self.coins[coin.id]
+
+
+class ArrayCoinPool:
+    """A CoinPool storing the state of its coins in parallel NumPy arrays, so that
+    filtering them is a boolean mask rather than a loop over the coins.
+
+    Each coin lives in a slot of the arrays, the slots of the removed coins are
+    reused. The FeebumpCoin objects are still kept along with their slot, as the
+    vaults and the transactions refer to them, and the coins are returned in the
+    same order as by the CoinPool.
+    """
+
+    def __init__(self, capacity=1024):
+        # A counter to generate unique ids for coins
+        self.coin_id = 0
+        # A map from the coin id to its slot, and the coin in each slot
+        self.slots = {}
+        self.coins = [None] * capacity
+        # The slots not holding any coin, the next one to be used last
+        self.free_slots = list(reversed(range(capacity)))
+        # The columns. A free slot has a state of -1, an unallocated coin a vault
+        # id of -1, and a coin whose fan block isn't known yet a fan block of -1.
+        self.amount = np.zeros(capacity, dtype=np.int64)
+        self.state = np.full(capacity, -1, dtype=np.int8)
+        self.fan_block = np.full(capacity, -1, dtype=np.int64)
+        self.vault_id = np.full(capacity, -1, dtype=np.int64)
+        # Whether the coin isn't allocated to a vault being spent or canceled
+        self.vault_ready = np.ones(capacity, dtype=bool)
+        # The order in which the coins were added to the pool, and in which they
+        # entered their current processing state.
+        self.seq = np.zeros(capacity, dtype=np.int64)
+        self.state_seq = np.zeros(capacity, dtype=np.int64)
+        self.n_seq = 0
+        # The ids of the vaults being spent or canceled
+        self.unready_vaults = set()
+
+    def grow(self):
+        """Double the number of slots."""
+        capacity = len(self.coins)
+        self.coins += [None] * capacity
+        self.free_slots = (
+            list(reversed(range(capacity, 2 * capacity))) + self.free_slots
+        )
+        for col, fill in [
+            ("amount", 0),
+            ("state", -1),
+            ("fan_block", -1),
+            ("vault_id", -1),
+            ("vault_ready", True),
+            ("seq", 0),
+            ("state_seq", 0),
+        ]:
+            array = getattr(self, col)
+            setattr(self, col, np.append(array, np.full(capacity, fill, array.dtype)))
+
+    def next_seq(self):
+        self.n_seq += 1
+        return self.n_seq
+
+    def new_coin_id(self):
+        self.coin_id += 1
+        return self.coin_id
+
+    def ordered(self, mask, key):
+        """The coins in the slots selected by {mask}, ordered by the {key} column."""
+        slots = np.flatnonzero(mask)
+        slots = slots[np.argsort(key[slots], kind="stable")]
+        return [self.coins[slot] for slot in slots.tolist()]
+
+    def n_coins(self):
+        return len(self.slots)
+
+    def list_coins(self):
+        return self.ordered(self.state >= 0, self.seq)
+
+    def coins_in_state(self, processing_state):
+        """The coins currently in this processing state."""
+        return self.ordered(self.state == processing_state.value, self.state_seq)
+
+    def balance(self):
+        balance = int(self.amount[self.state >= 0].sum())
+        if CHECK_BALANCES:
+            assert balance == sum(c.amount for c in self.coins if c is not None)
+        return balance
+
+    def unallocated_balance(self):
+        """The total value of the coins not allocated to any vault, whatever their
+        processing state."""
+        balance = int(self.amount[(self.state >= 0) & (self.vault_id < 0)].sum())
+        if CHECK_BALANCES:
+            assert balance == sum(
+                c.amount
+                for c in self.coins
+                if c is not None and not self.is_allocated(c)
+            )
+        return balance
+
+    def is_allocated(self, coin):
+        slot = self.slots.get(coin.id)
+        return slot is not None and self.vault_id[slot] >= 0
+
+    def coin_allocation(self, coin):
+        return int(self.vault_id[self.slots[coin.id]])
+
+    def set_vault_status(self, vault_id, status):
+        """Track the status of the vaults, for `cf_candidates`."""
+        if status == VaultState.READY:
+            self.unready_vaults.discard(vault_id)
+        else:
+            self.unready_vaults.add(vault_id)
+        self.vault_ready[self.vault_id == vault_id] = status == VaultState.READY
+
+    def forget_vault(self, vault_id):
+        """Stop tracking the status of a vault once it was removed."""
+        self.unready_vaults.discard(vault_id)
+
+    def cf_candidates(self, states, dust_thresh=None):
+        """The coins in any of these processing {states} that a CF tx may consume:
+        those not allocated to a vault being spent or canceled. If {dust_thresh} is
+        set, only the confirmed coins worth less than it.
+
+        They are ordered by state, then by the time they entered it.
+        """
+        # The rank of each state in {states}, len(states) for the others and for
+        # the free slots (the last entry, as their state is -1).
+        ranks = np.full(len(ProcessingState) + 1, len(states))
+        ranks[[s.value for s in states]] = np.arange(len(states))
+        rank = ranks[self.state]
+        mask = (rank < len(states)) & self.vault_ready
+        if dust_thresh is not None:
+            mask &= (self.state != ProcessingState.CONFIRMED.value) | (
+                self.amount < dust_thresh
+            )
+        slots = np.flatnonzero(mask)
+        slots = slots[np.lexsort((self.state_seq[slots], rank[slots]))]
+        return [self.coins[slot] for slot in slots.tolist()]
+
+    def unallocated_mask(self, min_amount, max_amount):
+        return (
+            (self.state == ProcessingState.CONFIRMED.value)
+            & (self.vault_id < 0)
+            & (self.amount >= min_amount)
+            & (self.amount <= max_amount)
+        )
+
+    def unallocated_coins(self, min_amount=0, max_amount=math.inf):
+        """Return coins that were fanned out but not yet allocated. Only those worth
+        between {min_amount} and {max_amount} if set."""
+        return self.ordered(self.unallocated_mask(min_amount, max_amount), self.seq)
+
+    def first_unallocated_coin(self, min_amount, max_amount):
+        """Return the first unallocated coin worth between {min_amount} and
+        {max_amount} (in the same order as `unallocated_coins`), or None."""
+        slots = np.flatnonzero(self.unallocated_mask(min_amount, max_amount))
+        if len(slots) == 0:
+            return None
+        return self.coins[slots[np.argmin(self.seq[slots])]]
+
+    def allocate_coin(self, coin, vault):
+        assert isinstance(coin, FeebumpCoin) and isinstance(vault, Vault)
+        assert not self.is_allocated(coin)
+        assert coin.is_confirmed()
+        slot = self.slots[coin.id]
+        self.vault_id[slot] = vault.id
+        self.vault_ready[slot] = vault.id not in self.unready_vaults
+
+    def deallocate_coin(self, coin):
+        self.deallocate_coins([coin])
+
+    def deallocate_coins(self, coins):
+        """Deallocate all these coins at once."""
+        slots = [self.slots[c.id] for c in coins]
+        assert (self.vault_id[slots] >= 0).all()
+        self.vault_id[slots] = -1
+        self.vault_ready[slots] = True
+
+    def take_slot(self):
+        if self.free_slots == []:
+            self.grow()
+        return self.free_slots.pop()
+
+    def add_coin(
+        self,
+        amount,
+        processing_state=ProcessingState.UNPROCESSED,
+        fan_block=None,
+        allocated_vault_id=None,
+        coin_id=None,
+    ):
+        coin_id = coin_id if coin_id is not None else self.new_coin_id()
+        coin = FeebumpCoin(coin_id, amount, processing_state, fan_block)
+        slot = self.take_slot()
+        self.slots[coin_id] = slot
+        self.coins[slot] = coin
+        self.amount[slot] = amount
+        self.state[slot] = processing_state.value
+        self.fan_block[slot] = fan_block if fan_block is not None else -1
+        if allocated_vault_id is not None:
+            assert isinstance(allocated_vault_id, int)
+            self.vault_id[slot] = allocated_vault_id
+            self.vault_ready[slot] = allocated_vault_id not in self.unready_vaults
+        self.seq[slot] = self.state_seq[slot] = self.next_seq()
+        return coin
+
+    def add_coins(self, amounts, processing_state=ProcessingState.UNPROCESSED):
+        """Add unallocated coins worth these {amounts} at once. Same as calling
+        `add_coin` for each amount, in order, but they can't be confirmed."""
+        assert processing_state != ProcessingState.CONFIRMED
+        while len(self.free_slots) < len(amounts):
+            self.grow()
+        slots = [self.free_slots.pop() for _ in amounts]
+        coins = []
+        for slot, amount in zip(slots, amounts):
+            coin = FeebumpCoin(self.new_coin_id(), amount, processing_state)
+            self.slots[coin.id] = slot
+            self.coins[slot] = coin
+            coins.append(coin)
+        self.amount[slots] = amounts
+        self.state[slots] = processing_state.value
+        self.seq[slots] = self.state_seq[slots] = np.arange(
+            self.n_seq + 1, self.n_seq + len(amounts) + 1
+        )
+        self.n_seq += len(amounts)
+        return coins
+
+    def confirm_coin(self, coin, fan_height):
+        self.confirm_coins([coin], fan_height)
+
+    def confirm_coins(self, coins, fan_height):
+        """Confirm all these unconfirmed coins at once."""
+        slots = [self.slots[c.id] for c in coins]
+        assert (self.vault_id[slots] < 0).all()
+        for slot in slots:
+            self.coins[slot].confirm(fan_height)
+        self.state[slots] = ProcessingState.CONFIRMED.value
+        self.fan_block[slots] = fan_height
+        self.state_seq[slots] = np.arange(self.n_seq + 1, self.n_seq + len(slots) + 1)
+        self.n_seq += len(slots)
+
+    def remove_coin(self, coin):
+        """Remove a coin from the pool by value"""
+        self.remove_coins([coin])
+
+    def remove_coins(self, coins):
+        """Remove all these coins from the pool at once, freeing their slots."""
+        slots = [self.slots.pop(c.id) for c in coins]
+        for slot in slots:
+            self.coins[slot] = None
+        self.amount[slots] = 0
+        self.state[slots] = -1
+        self.fan_block[slots] = -1
+        self.vault_id[slots] = -1
+        self.vault_ready[slots] = True
+        self.free_slots += slots
+
+
+# The coin pool backends the StateMachine may use
+COIN_POOLS = {"object": CoinPool, "array": ArrayCoinPool}
+
+
+class AvailableVaults:
+    """The set of the available vaults, along with their reserve balance packed in
+    an array so that it can be compared to the requirement for all of them at once.
+
+    The order of the vaults is arbitrary: removing one moves the last one in its
+    place. This makes adding, removing and picking a vault at random constant time.
+    """
+
+    def __init__(self, capacity=64):
+        self.amounts = np.zeros(capacity, dtype=np.int64)
+        # The id of the vault at each position in the array, and the other way around
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, vault_id):
+        return vault_id in self.positions
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def choice(self, rng=random):
+        """The id of an available vault picked uniformly at random."""
+        return self.ids[rng.randrange(len(self.ids))]
+
+    def set(self, vault_id, amount):
+        """Set the reserve balance of this vault, adding it if it wasn't there."""
+        pos = self.positions.get(vault_id)
+        if pos is None:
+            pos = len(self.ids)
+            if pos == len(self.amounts):
+                self.amounts = np.concatenate(
+                    (self.amounts, np.zeros_like(self.amounts))
+                )
+            self.ids.append(vault_id)
+            self.positions[vault_id] = pos
+        self.amounts[pos] = amount
+
+    def discard(self, vault_id):
+        pos = self.positions.pop(vault_id, None)
+        if pos is None:
+            return
+        last_id = self.ids.pop()
+        if last_id != vault_id:
+            self.ids[pos] = last_id
+            self.positions[last_id] = pos
+            self.amounts[pos] = self.amounts[len(self.ids)]
+
+    def array(self):
+        """The reserve balances, as a view on the array. Only valid until the next
+        update."""
+        return self.amounts[: len(self.ids)]
+
 
 class StateMachine:
     """Watchtower state machine."""
@@ -254,18 +1073,20 @@ class StateMachine:
         fallback_est_strat,
         cf_coin_selec,
         cancel_coin_selec,
+        fee_cache_dir=None,
+        fee_history_path=None,
+        coin_pool="object",
     ):
         self.n_stk = n_stk
         self.n_man = n_man
         self.locktime = locktime
         self.vaults = {}
-        self.coin_pool = CoinPool()
-        # List of relevant unconfirmed transactions: [Tx, Tx, Tx,...]
-        self.mempool = []
-
-        self.hist_df = read_csv(
-            hist_feerate_csv, parse_dates=True, index_col="block_height"
-        )
+        # The coins are either stored as objects or in arrays, see ArrayCoinPool
+        if coin_pool not in COIN_POOLS:
+            raise ValueError(f"Unknown coin pool '{coin_pool}'")
+        self.coin_pool = COIN_POOLS[coin_pool]()
+        # The relevant unconfirmed transactions
+        self.mempool = Mempool(locktime)
 
         # analysis strategy over historical feerates for fee_reserve
         self.reserve_strat = reserve_strat
@@ -278,75 +1099,35 @@ class StateMachine:
         # FIXME: make it configurable by env vars?
         self.I_2_tol = 0.3
 
-        # avoid unnecessary search by caching fee reserve per vault, feerate
-        self.frpv = (None, None)  # block, value
-        self.feerate = (None, None)  # block, value
+        # The coin distributions already computed, by (reserve feerate, fallback
+        # feerate). They are queried many times per block and the reserve feerate
+        # seldom changes.
+        self.coins_dist_cache = {}
 
-        # Prepare the rolling stats
-        thirty_days = 144 * 30
-        ninety_days = 144 * 90
-        logging.debug("Preparing the fee estimation data.")
-
-        if self.fallback_est_strat == "MA30":
-            self.hist_df["MA30"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(thirty_days, min_periods=144)
-                .mean()
-            )
-        elif self.fallback_est_strat == "ME30":
-            self.hist_df["ME30"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(thirty_days, min_periods=144)
-                .median()
-            )
-        elif self.fallback_est_strat == "85Q1H":
-            self.hist_df["85Q1H"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(6, min_periods=1)
-                .quantile(quantile=0.85, interpolation="linear")
-            )
+        # The historical feerates along with the rolling stats used by the
+        # strategies, as plain arrays for fast lookups. If we were given an already
+        # prepared cache entry, just map it.
+        if fee_history_path is not None:
+            self.fee_history = FeeHistory.load(fee_history_path, mmap=True)
         else:
-            raise ValueError("Estimate strategy not implemented")
-
-        if self.reserve_strat == "95Q30":
-            self.hist_df["95Q30"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(thirty_days, min_periods=144)
-                .quantile(quantile=0.95, interpolation="linear")
-            )
-        elif self.reserve_strat == "95Q90":
-            self.hist_df["95Q90"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(ninety_days, min_periods=144)
-                .quantile(quantile=0.95, interpolation="linear")
-            )
-        elif self.reserve_strat == "CUMMAX95Q90":
-            self.hist_df["CUMMAX95Q90"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(ninety_days, min_periods=144)
-                .quantile(quantile=0.95, interpolation="linear")
-                .cummax()
+            self.fee_history = load_fee_history(
+                hist_feerate_csv, reserve_strat, fallback_est_strat, fee_cache_dir
             )
-        elif self.reserve_strat == "CUMMAX95Q1":
-            self.hist_df["CUMMAX95Q1"] = (
-                self.hist_df["mean_feerate"]
-                .rolling(144, min_periods=14)
-                .quantile(quantile=0.95, interpolation="linear")
-                .cummax()
-            )
-        else:
-            raise ValueError("Reserve strategy not implemented")
-
-        self.hist_df["ME90"] = (
-            self.hist_df["mean_feerate"].rolling(ninety_days, min_periods=144).median()
-        )
-        self.hist_df["20Q90"] = (
-            self.hist_df["mean_feerate"]
-            .rolling(ninety_days, min_periods=144)
-            .quantile(quantile=0.2)
-        )
-
-        logging.debug("Done processing the fee estimation data.")
+        # Built on first use, see cancel_replacement_height()
+        self.next_block_feerate_index = None
+
+        # The ids of the available vaults under requirement at the reserve feerate
+        # they were last checked at. Only the vaults whose coins or status changed
+        # since are checked again, unless the reserve feerate changed. See
+        # vaults_at_risk().
+        self.risky_vaults = set()
+        self.risk_feerate = None
+        self.changed_vaults = set()
+        # The available vaults and their reserve balance, see reserve_balances()
+        self.available_vaults = AvailableVaults()
+        # The rank of each vault in {vaults}, which is in allocation order
+        self.vaults_rank = {}
+        self.allocations_count = 0
 
     def list_vaults(self):
         return list(self.vaults.values())
@@ -357,41 +1138,86 @@ class StateMachine:
     def list_available_vaults(self):
         return [v for v in self.list_vaults() if v.is_available()]
 
+    def available_vaults_count(self):
+        return len(self.available_vaults)
+
+    def available_vault_ids(self):
+        """The ids of the available vaults, in no particular order. Not a copy: only
+        valid until the next change to the vaults."""
+        return self.available_vaults.ids
+
+    def random_available_vault(self):
+        """The id of an available vault picked uniformly at random."""
+        return self.available_vaults.choice()
+
     def list_coins(self):
         return list(self.coin_pool.list_coins())
 
     def unconfirmed_transactions(self):
         return self.mempool
 
+    def vault_changed(self, vault_id):
+        """Account for a change in the coins or the status of this vault, or for its
+        creation or removal."""
+        self.changed_vaults.add(vault_id)
+        vault = self.vaults.get(vault_id)
+        if vault is not None and vault.is_available():
+            self.available_vaults.set(vault_id, vault.reserve_amount)
+        else:
+            self.available_vaults.discard(vault_id)
+
+    def reserve_balances(self):
+        """The reserve balance of each available vault, as an array in no
+        particular order. Only valid until the next change to the vaults."""
+        balances = self.available_vaults.array()
+        if CHECK_BALANCES:
+            assert sorted(balances.tolist()) == sorted(
+                v.reserve_balance() for v in self.list_available_vaults()
+            )
+        return balances
+
     def allocate_coin(self, coin, vault):
         self.coin_pool.allocate_coin(coin, vault)
         vault.allocate_coin(coin)
+        self.vault_changed(vault.id)
 
     def remove_coin(self, coin):
         if self.coin_pool.is_allocated(coin):
             vault_id = self.coin_pool.coin_allocation(coin)
             self.vaults[vault_id].deallocate_coin(coin)
+            self.vault_changed(vault_id)
         self.coin_pool.remove_coin(coin)
 
-    def grab_coins(self, f):
-        """Grab coins from the pool according to a filter."""
+    def grab_coins(self, f, states=tuple(ProcessingState)):
+        """Grab coins in any of these processing states from the pool according to
+        a filter."""
         coins = []
 
-        for coin in list(self.coin_pool.list_coins()):
-            if f(coin):
-                coins.append(coin)
+        for state in states:
+            for coin in self.coin_pool.coins_in_state(state):
+                if f(coin):
+                    coins.append(coin)
 
         return coins
 
     def remove_coins(self, coins):
-        """Remove all these coins from the pool."""
-        for c in coins:
-            self.remove_coin(c)
+        """Remove all these coins from the pool, at once."""
+        changed_vaults = {}
+        for coin in coins:
+            if self.coin_pool.is_allocated(coin):
+                vault_id = self.coin_pool.coin_allocation(coin)
+                self.vaults[vault_id].deallocate_coin(coin)
+                changed_vaults[vault_id] = None
+        self.coin_pool.remove_coins(coins)
+        for vault_id in changed_vaults:
+            self.vault_changed(vault_id)
 
     def remove_vault(self, vault):
-        for coin in vault.allocated_coins():
-            self.coin_pool.deallocate_coin(coin)
+        self.coin_pool.deallocate_coins(list(vault.allocated_coins()))
+        self.coin_pool.forget_vault(vault.id)
         del self.vaults[vault.id]
+        del self.vaults_rank[vault.id]
+        self.vault_changed(vault.id)
 
     def feerate_reserve_per_vault(self, block_height):
         """Return feerate reserve per vault (satoshi/vbyte). The value is determined from a
@@ -401,11 +1227,8 @@ class StateMachine:
         Note how we assume the presigned feerate to be 0. It's 88 "For Real"
         (in practical-revault).
         """
-        if self.frpv[0] == block_height:
-            return self.frpv[1]
-
-        self.frpv = (block_height, self.hist_df[self.reserve_strat][block_height])
-        return self.frpv[1]
+        fh = self.fee_history
+        return fh.reserve_feerate[block_height - fh.start_height]
 
     def fallback_feerate(self, block_height):
         """Return a block chain based feerate estimate (satoshi/vbyte).
@@ -414,24 +1237,19 @@ class StateMachine:
         using one of the implemented strategies chosen with the self.fallback_est_strat
         parameter.
         """
-        if self.feerate[0] == block_height:
-            return self.feerate[1]
-
-        self.feerate = (
-            block_height,
-            self.hist_df[self.fallback_est_strat][block_height],
-        )
-        return self.feerate[1]
+        fh = self.fee_history
+        return fh.fallback_feerate[block_height - fh.start_height]
 
     def next_block_feerate(self, height):
         """Value of `estimatesmartfee 1 CONSERVATIVE`.
 
         When estimates aren't available, use the user-provided fallback method.
         """
-        try:
-            return int(self.hist_df["est_1block"][height])
-        except ValueError:
+        fh = self.fee_history
+        estimate = fh.est_1block[height - fh.start_height]
+        if math.isnan(estimate):
             return self.fallback_feerate(height)
+        return int(estimate)
 
     def cancel_vbytes(self):
         """Size of the Cancel transaction without any feebump input"""
@@ -449,9 +1267,27 @@ class StateMachine:
     def is_tx_confirmed(self, tx, height):
         """We consider a transaction to have been confirmed in this block if its
         feerate was above the min feerate in this block."""
-        min_feerate = self.hist_df["min_feerate"][height]
-        min_feerate = 0 if min_feerate == "NaN" else float(min_feerate)
-        return tx.feerate() > min_feerate
+        fh = self.fee_history
+        return tx.feerate() > fh.min_feerate[height - fh.start_height]
+
+    def tx_confirmation_height(self, tx, height):
+        """The first height from {height} at which this transaction would be
+        confirmed (see is_tx_confirmed()), None if never."""
+        return self.fee_history.first_confirmation_height(tx.feerate(), height)
+
+    def cancel_replacement_height(self, tx, height):
+        """The first height from {height} at which this Cancel transaction would
+        be replaced if still unconfirmed (see maybe_replace_cancel()), None if
+        never."""
+        if self.next_block_feerate_index is None:
+            fh = self.fee_history
+            # See next_block_feerate()
+            feerates = np.where(
+                np.isnan(fh.est_1block), fh.fallback_feerate, np.trunc(fh.est_1block)
+            )
+            # We want the first height with a feerate above the tx's
+            self.next_block_feerate_index = FirstBelowIndex(fh.start_height, -feerates)
+        return self.next_block_feerate_index.first_below(-tx.feerate(), height)
 
     def min_acceptable_fbcoin_value(self, height):
         """The minimum value for a feebumping coin we create is one that allows
@@ -468,27 +1304,58 @@ class StateMachine:
 
         See `fb_coins_dist` docstring for more details.
         """
-        reserve_feerate = self.feerate_reserve_per_vault(block_height)
-        reserve_fee = self.fee_reserve_per_vault(block_height)
-        min_large_coin = self.min_acceptable_fbcoin_value(block_height)
-        return coins_dist_rec(reserve_fee, min_large_coin, reserve_feerate)
+        return self.coins_dist(block_height)[0]
 
-    def coins_dist_bonus(self, block_height, total_value):
+    def coins_dist_bonus(self, block_height):
         """The 'bonus' part of the coins amount distribution.
 
         See `fb_coins_dist` docstring for more details.
         """
+        return self.coins_dist(block_height)[1]
+
+    def compute_coins_dist(self, block_height):
+        """Compute the reserve, bonus and whole coin amount distributions.
+
+        See `fb_coins_dist` docstring for more details.
+        """
+        reserve_feerate = self.feerate_reserve_per_vault(block_height)
+        reserve_fee = self.fee_reserve_per_vault(block_height)
+        min_large_coin = self.min_acceptable_fbcoin_value(block_height)
+        large_coins = coins_dist_rec(reserve_fee, min_large_coin, reserve_feerate)
         curr_feerate = self.fallback_feerate(block_height)
         min_small_coin = self.cancel_tx_fee(curr_feerate, 1)
-        return coins_dist_rec(total_value, min_small_coin, curr_feerate)
+        small_coins = coins_dist_rec(large_coins[-1], min_small_coin, curr_feerate)
+        return (
+            coins_dist(large_coins),
+            coins_dist(small_coins),
+            coins_dist(large_coins + small_coins),
+        )
+
+    def cached_coins_dist(self, block_height):
+        """Get the reserve, bonus and whole coin amount distributions at this
+        height, only computing them if they weren't already for these feerates.
+
+        The distributions only depend on the reserve and fallback feerates.
+        """
+        key = (
+            self.feerate_reserve_per_vault(block_height),
+            self.fallback_feerate(block_height),
+        )
+        dists = self.coins_dist_cache.get(key)
+        if dists is None:
+            dists = self.compute_coins_dist(block_height)
+            if len(self.coins_dist_cache) >= COINS_DIST_CACHE_SIZE:
+                # Evict the oldest entry
+                del self.coins_dist_cache[next(iter(self.coins_dist_cache))]
+            self.coins_dist_cache[key] = dists
+        return dists
 
     def coins_dist(self, block_height):
         """Helper to get the non-concatenated amount distribution.
 
         See `fb_coins_dist` for details.
         """
-        large_coins = self.coins_dist_reserve(block_height)
-        small_coins = self.coins_dist_bonus(block_height, large_coins[-1])
+        large_coins, small_coins, _ = self.cached_coins_dist(block_height)
         return large_coins, small_coins
 
     def fb_coins_dist(self, block_height):
@@ -503,30 +1370,112 @@ class StateMachine:
         Note all the input data for the coin distribution function is based on the
         block chain, allowing operators' wallets to deterministically compute it.
         """
-        large_coins, small_coins = self.coins_dist(block_height)
-        return large_coins + small_coins
+        return self.cached_coins_dist(block_height)[2]
 
-    def unallocated_balance(self):
-        return sum(
-            [
-                coin.amount
-                for coin in self.coin_pool.list_coins()
-                if not self.coin_pool.is_allocated(coin)
-            ]
+    def coins_dist_totals(self, start_height, end_height):
+        """The total value of the reserve part of the coin distribution and of the
+        whole coin distribution, for each height in [{start_height}, {end_height}[.
+
+        Same as summing `coins_dist_reserve` and `fb_coins_dist` at each height,
+        computed at once.
+        """
+        fh = self.fee_history
+        index = slice(start_height - fh.start_height, end_height - fh.start_height)
+        reserve_feerate = fh.reserve_feerate[index]
+        curr_feerate = fh.fallback_feerate[index]
+        # See `compute_coins_dist`
+        reserve_fee = (self.cancel_vbytes() * reserve_feerate).astype(np.int64)
+        min_large_coin = (
+            reserve_feerate * P2WPKH_INPUT_SIZE
+            + self.cancel_tx_fee(MIN_BUMP_WORST_CASE, 0)
+        ).astype(np.int64)
+        min_small_coin = (
+            (self.cancel_vbytes() + P2WPKH_INPUT_SIZE) * curr_feerate
+        ).astype(np.int64)
+        reserve_totals = coins_dist_rec_totals(
+            reserve_fee, min_large_coin, reserve_feerate
         )
+        # The bonus part starts from the smallest coin of the reserve part, which is
+        # always the minimum large coin value.
+        bonus_totals = coins_dist_rec_totals(
+            min_large_coin, min_small_coin, curr_feerate
+        )
+        return reserve_totals, reserve_totals + bonus_totals
+
+    def unallocated_balance(self):
+        return self.coin_pool.unallocated_balance()
 
     def balance(self):
         return self.coin_pool.balance()
 
-    def under_requirement(self, vault, block_height):
+    def reserve_requirement(self, block_height):
+        """The usable balance a vault needs at this height to be able to bump at
+        reserve feerate, along with the minimum value of a usable coin.
+
+        Both only depend on the reserve feerate.
+        """
+        return (
+            self.coins_dist_reserve(block_height).total,
+            self.min_fbcoin_value(block_height),
+        )
+
+    def under_requirement(self, vault, block_height, requirement=None):
         """Returns whether a given vault wouldn't be able to bump at reserve feerate."""
-        required_reserve = sum(self.coins_dist_reserve(block_height))
-        min_coin_value = self.min_fbcoin_value(block_height)
+        if requirement is None:
+            requirement = self.reserve_requirement(block_height)
+        required_reserve, min_coin_value = requirement
         usable_balance = sum(
             [c.amount for c in vault.fb_coins.values() if c.amount >= min_coin_value]
         )
         return usable_balance < required_reserve
 
+    def update_risky_vaults(self, block_height):
+        """Update the set of available vaults under requirement for this height."""
+        feerate = self.feerate_reserve_per_vault(block_height)
+        if feerate == self.risk_feerate:
+            vault_ids = self.changed_vaults
+        else:
+            # The requirement changed, check all the vaults again
+            self.risk_feerate = feerate
+            vault_ids = self.available_vaults
+            self.risky_vaults = set()
+        requirement = self.reserve_requirement(block_height)
+        for vault_id in vault_ids:
+            vault = self.vaults.get(vault_id)
+            if (
+                vault is not None
+                and vault.is_available()
+                and self.under_requirement(vault, block_height, requirement)
+            ):
+                self.risky_vaults.add(vault_id)
+            else:
+                self.risky_vaults.discard(vault_id)
+        self.changed_vaults = set()
+        if CHECK_BALANCES:
+            assert self.risky_vaults == {
+                v.id
+                for v in self.list_available_vaults()
+                if self.under_requirement(v, block_height, requirement)
+            }
+
+    def vaults_at_risk(self, block_height):
+        """The number of available vaults under requirement at this height."""
+        self.update_risky_vaults(block_height)
+        return len(self.risky_vaults)
+
+    def vaults_under_requirement(self, block_height):
+        """The available vaults under requirement at this height, in the same order
+        as in `list_available_vaults`.
+
+        Only the vaults that lost coins or changed status since they were last
+        checked are checked again, unless the requirement changed.
+        """
+        self.update_risky_vaults(block_height)
+        return [
+            self.vaults[vault_id]
+            for vault_id in sorted(self.risky_vaults, key=self.vaults_rank.__getitem__)
+        ]
+
     def refill(self, amount):
         """Refill the WT by generating a new feebump coin worth 'amount', with no allocation."""
         assert isinstance(amount, int)
@@ -538,21 +1487,9 @@ class StateMachine:
 
         This version grabs all the feebump coins available.
         """
-
-        def coin_filter(coin):
-            if coin.is_unconfirmed():
-                return False
-
-            if (
-                self.coin_pool.is_allocated(coin)
-                and self.vaults[self.coin_pool.coin_allocation(coin)].status
-                != VaultState.READY
-            ):
-                return False
-
-            return True
-
-        return self.grab_coins(coin_filter)
+        return self.coin_pool.cf_candidates(
+            [ProcessingState.UNPROCESSED, ProcessingState.CONFIRMED]
+        )
 
     def cf_coin_selec_1(self, block_height):
         """Select coins to consume as inputs for the CF transaction,
@@ -564,32 +1501,21 @@ class StateMachine:
         90 blocks. A low fee period is detected when the next block feerate is below
         below the 20th percentile over the last 90 blocks.
         """
+        fh = self.fee_history
+        index = block_height - fh.start_height
         feerate = self.next_block_feerate(block_height)
-        low_fee_period = feerate < self.hist_df["20Q90"][block_height]
-
-        def coin_filter(coin):
-            if coin.is_unconfirmed():
-                return False
-
-            if (
-                self.coin_pool.is_allocated(coin)
-                and self.vaults[self.coin_pool.coin_allocation(coin)].status
-                != VaultState.READY
-            ):
-                return False
-
-            if coin.is_unprocessed():
-                return True
-            else:
-                is_dust = coin.amount < P2WPKH_INPUT_SIZE * self.hist_df["ME90"][
-                    block_height
-                ] + self.cancel_tx_fee(1, 0)
-                return is_dust and low_fee_period
+        low_fee_period = feerate < fh.q20_90[index]
+        dust_thresh = P2WPKH_INPUT_SIZE * fh.me90[index] + self.cancel_tx_fee(1, 0)
 
-        return self.grab_coins(coin_filter)
+        # Confirmed coins are only consolidated if they are dust during a low fee
+        # period.
+        states = [ProcessingState.UNPROCESSED]
+        if low_fee_period:
+            states.append(ProcessingState.CONFIRMED)
+        return self.coin_pool.cf_candidates(states, dust_thresh)
 
     def cf_coin_selec_2(self, height):
-        return self.grab_coins(lambda c: c.is_unprocessed())
+        return self.coin_pool.cf_candidates([ProcessingState.UNPROCESSED])
 
     def min_fbcoin_value(self, height):
         """The absolute minimum value for a feebumping coin.
@@ -630,103 +1556,66 @@ class StateMachine:
         feerate = self.next_block_feerate(block_height)
 
         # FIXME this doesn't re-create enough coins if we consolidated some.
-        added_coins = []
-        # Keep track of the CF tx size and fees as we add outputs
         cf_size = cf_tx_size(n_inputs=len(coins), n_outputs=0)
         cf_tx_fee = int(cf_size * feerate)
         # The cost of a distribution for a single vault in the CF tx
-        dist_rese_size = P2WPKH_OUTPUT_SIZE * len(dist_reserve)
+        dist_rese_size = P2WPKH_OUTPUT_SIZE * len(dist_reserve.amounts)
         dist_rese_fees = int(dist_rese_size * feerate)
-        dist_rese_cost = sum(dist_reserve) + dist_rese_fees
-        dist_bonu_size = P2WPKH_OUTPUT_SIZE * len(dist_bonus)
+        dist_rese_cost = dist_reserve.total + dist_rese_fees
+        dist_bonu_size = P2WPKH_OUTPUT_SIZE * len(dist_bonus.amounts)
         dist_bonu_fees = int(dist_bonu_size * feerate)
-        dist_bonu_cost = sum(dist_bonus) + dist_bonu_fees
+        dist_bonu_cost = dist_bonus.total + dist_bonu_fees
         # The cost of a change output should we need to add one
         change_size = P2WPKH_OUTPUT_SIZE
         change_fee = P2WPKH_OUTPUT_SIZE * feerate
-        # Add new distributions of coins to the CF until we can't afford it anymore
+        # Add as many new distributions of coins to the CF as we can afford
         total_to_consume = sum(c.amount for c in coins)
-        num_new_reserves = 0
-        num_new_bonuses = 0
-        consumed = 0
-        while True:
-            # First do the reserve
-            if consumed + dist_rese_cost > total_to_consume:
-                break
-            # Don't create a new set of outputs if we can't pay the fees for it
-            if total_to_consume - consumed - dist_rese_cost <= cf_tx_fee:
-                break
-            # Don't create a too large tx, instead add a change output (always
-            # smaller than dist_rese_size) to be processed by a latter CF tx.
-            if cf_size + dist_rese_size > MAX_TX_SIZE:
-                assert cf_size + change_size <= MAX_TX_SIZE, "No room for change output"
-                added_coins.append(
-                    self.coin_pool.add_coin(
-                        total_to_consume - consumed - change_fee,
-                        processing_state=ProcessingState.UNPROCESSED,
-                    )
-                )
-                cf_size += change_size
-                cf_tx_fee += change_fee
-                break
-            consumed += dist_rese_cost
-            cf_size += dist_rese_size
-            cf_tx_fee += int(dist_rese_size * feerate)
-
-            num_new_reserves += 1
-            for x in dist_reserve:
-                added_coins.append(
-                    self.coin_pool.add_coin(x, processing_state=ProcessingState.PENDING)
-                )
-
-            # Then if we still have enough do the bonus
-            if consumed + dist_bonu_cost > total_to_consume:
-                continue
-            # Don't create a new set of outputs if we can't pay the fees for it
-            if total_to_consume - consumed - dist_bonu_cost <= cf_tx_fee:
-                break
-            # Don't create a too large tx, instead add a change output (always
-            # smaller than dist_rese_size) to be processed by a latter CF tx.
-            if cf_size + dist_bonu_size > MAX_TX_SIZE:
-                assert cf_size + change_size <= MAX_TX_SIZE, "No room for change output"
-                added_coins.append(
-                    self.coin_pool.add_coin(
-                        total_to_consume - consumed - change_fee,
-                        processing_state=ProcessingState.UNPROCESSED,
-                    )
-                )
-                cf_size += change_size
-                cf_tx_fee += change_fee
-                break
-            consumed += dist_bonu_cost
-            cf_size += dist_bonu_size
-            cf_tx_fee += int(dist_bonu_size * feerate)
-
-            num_new_bonuses += 1
-            for x in dist_bonus:
-                added_coins.append(
-                    self.coin_pool.add_coin(x, processing_state=ProcessingState.PENDING)
-                )
+        num_new_reserves, num_new_bonuses, contains_change = cf_distributions_count(
+            total_to_consume,
+            cf_size,
+            cf_tx_fee,
+            (dist_rese_cost, dist_rese_size, dist_rese_fees),
+            (dist_bonu_cost, dist_bonu_size, dist_bonu_fees),
+        )
+        consumed = num_new_reserves * dist_rese_cost + num_new_bonuses * dist_bonu_cost
+        cf_size += num_new_reserves * dist_rese_size + num_new_bonuses * dist_bonu_size
+        cf_tx_fee += (
+            num_new_reserves * dist_rese_fees + num_new_bonuses * dist_bonu_fees
+        )
+        # Each reserve distribution but the last one is followed by a bonus one
+        amounts = list(dist_reserve.amounts + dist_bonus.amounts) * num_new_bonuses
+        amounts += list(dist_reserve.amounts) * (num_new_reserves - num_new_bonuses)
+        # Don't create a too large tx, instead add a change output (always smaller
+        # than dist_rese_size) to be processed by a latter CF tx.
+        if contains_change:
+            assert cf_size + change_size <= MAX_TX_SIZE, "No room for change output"
+            change_amount = total_to_consume - consumed - change_fee
+            cf_size += change_size
+            cf_tx_fee += change_fee
 
         if num_new_reserves == 0:
             logging.debug(
                 "        CF Tx failed sice num_new_reserves = 0 (not accounting for"
                 " expected fee)"
             )
+            # FIXME: the change output is added to the pool, even though we don't
+            # broadcast the CF tx.
+            if contains_change:
+                self.coin_pool.add_coin(
+                    change_amount, processing_state=ProcessingState.UNPROCESSED
+                )
             # Not enough in available coins to fanout to 1 complete fee_reserve, so
             # return 0 (as in, 0 fee paid)
             return 0
 
         # If a change output was appended to the outputs, it contains the
         # remainder.
-        contains_change = (
-            added_coins[-1].processing_state == ProcessingState.UNPROCESSED
-        )
+        extra_amounts = []
         if not contains_change:
             remainder = (
                 total_to_consume
-                - (num_new_reserves * sum(dist_reserve))
-                - (num_new_bonuses * sum(dist_bonus))
+                - (num_new_reserves * dist_reserve.total)
+                - (num_new_bonuses * dist_bonus.total)
             )
             assert isinstance(remainder, int)
             assert (
@@ -751,33 +1640,33 @@ class StateMachine:
                     added_coin_value = int(
                         (remainder - outputs_fee) / added_coins_count
                     )
-                    for _ in range(added_coins_count):
-                        added_coins.append(
-                            self.coin_pool.add_coin(
-                                added_coin_value,
-                                processing_state=ProcessingState.PENDING,
-                            )
-                        )
+                    extra_amounts = [added_coin_value] * added_coins_count
                     cf_tx_fee += outputs_fee
                 else:
                     # And fallback to distribute the excess across the created fb coins
-                    num_outputs = num_new_reserves * len(
-                        dist_reserve
-                    ) + num_new_bonuses * len(dist_bonus)
-                    increase = remainder // num_outputs
-                    for coin in added_coins:
-                        coin.increase_amount(increase)
+                    increase = remainder // len(amounts)
+                    amounts = [x + increase for x in amounts]
+
+        added_coins = self.coin_pool.add_coins(
+            amounts + extra_amounts, processing_state=ProcessingState.PENDING
+        )
+        if contains_change:
+            added_coins.append(
+                self.coin_pool.add_coin(
+                    change_amount, processing_state=ProcessingState.UNPROCESSED
+                )
+            )
 
         self.remove_coins(coins)
-        self.mempool.append(ConsolidateFanoutTx(block_height, coins, added_coins))
+        self.mempool.add(ConsolidateFanoutTx(block_height, coins, added_coins))
         return cf_tx_fee
 
     def finalize_consolidate_fanout(self, tx, height):
         """Confirm cosnolidate_fanout tx and update the coin pool."""
         if self.is_tx_confirmed(tx, height):
-            for coin in tx.txouts:
-                if coin.is_unconfirmed():
-                    self.coin_pool.confirm_coin(coin, height)
+            self.coin_pool.confirm_coins(
+                [coin for coin in tx.txouts if coin.is_unconfirmed()], height
+            )
             self.mempool.remove(tx)
             return True
         return False
@@ -816,11 +1705,10 @@ class StateMachine:
         usable = [] if not remove_vault else list(vault.allocated_coins())
         usable += [
             c.amount
-            for c in self.coin_pool.unallocated_coins()
-            if c.amount >= min_coin_value
+            for c in self.coin_pool.unallocated_coins(min_amount=min_coin_value)
         ]
         total_usable = sum(usable)
-        required_reserve = sum(dist_req)
+        required_reserve = dist_req.total
 
         if required_reserve > total_usable:
             raise AllocationError(required_reserve, total_usable)
@@ -831,29 +1719,30 @@ class StateMachine:
 
         self.vaults[vault_id] = Vault(vault_id, amount)
         vault = self.vaults[vault_id]
+        self.allocations_count += 1
+        self.vaults_rank[vault_id] = self.allocations_count
+        self.vault_changed(vault_id)
         # First optimistically search for coins in the required reserve with
         # small tolerance.
         tolerances = [0.05, 0.1, 0.2, 0.3]
+        dist_req = dist_req.amounts
         for tol in tolerances:
             not_found = []
             for x in dist_req:
-                try:
-                    fbcoin = next(
-                        coin
-                        for coin in self.coin_pool.unallocated_coins()
-                        if ((1 - tol / 2) * x <= coin.amount <= (1 + tol) * x)
-                    )
-                    self.allocate_coin(fbcoin, vault)
-                    logging.debug(
-                        f"    {fbcoin} found with tolerance {tol*100}%, added to"
-                        f" fee reserve. Distribution value: {x}"
-                    )
-                except (StopIteration):
+                fbcoin = self.coin_pool.first_unallocated_coin(
+                    (1 - tol / 2) * x, (1 + tol) * x
+                )
+                if fbcoin is None:
                     logging.debug(
                         f"    No coin found with amount = {x} with tolerance {tol*100}%"
                     )
                     not_found.append(x)
                     continue
+                self.allocate_coin(fbcoin, vault)
+                logging.debug(
+                    f"    {fbcoin} found with tolerance {tol*100}%, added to"
+                    f" fee reserve. Distribution value: {x}"
+                )
             # If there was any failure, try again with a wider tolerance for
             # remaining not found amounts
             dist_req = not_found
@@ -864,12 +1753,11 @@ class StateMachine:
         # If we couldn't find large enough coins close to the dist, complete
         # with coins off the dist but make sure they increase the fee at the
         # worst case feerate.
-        for coin in self.coin_pool.unallocated_coins():
-            if coin.amount >= min_coin_value:
-                self.allocate_coin(coin, vault)
-                logging.debug(f"    {coin} found to complete")
-                if vault.reserve_balance() >= required_reserve:
-                    break
+        for coin in self.coin_pool.unallocated_coins(min_amount=min_coin_value):
+            self.allocate_coin(coin, vault)
+            logging.debug(f"    {coin} found to complete")
+            if vault.reserve_balance() >= required_reserve:
+                break
 
         assert vault.reserve_balance() >= required_reserve, (
             f"Was checked before searching, {vault.reserve_balance()} vs"
@@ -878,11 +1766,10 @@ class StateMachine:
 
         # Now we have enough coins for the required reserve we can look for
         # coins in the bonus reserve
-        for x in dist_bonus:
-            for coin in self.coin_pool.unallocated_coins():
-                if x * 0.7 <= coin.amount <= x * 1.3:
-                    self.allocate_coin(coin, vault)
-                    break
+        for x in dist_bonus.amounts:
+            coin = self.coin_pool.first_unallocated_coin(x * 0.7, x * 1.3)
+            if coin is not None:
+                self.allocate_coin(coin, vault)
 
         logging.debug(
             f"    Reserve for vault {vault.id} has excess of"
@@ -907,7 +1794,9 @@ class StateMachine:
             cancel_fb_inputs = self.cancel_coin_selec_1(vault, needed_fee, feerate)
 
         vault.set_status(VaultState.CANCELING)
-        self.mempool.append(
+        self.coin_pool.set_vault_status(vault.id, vault.status)
+        self.vault_changed(vault.id)
+        self.mempool.add(
             CancelTx(
                 block_height,
                 vault.id,
@@ -1020,27 +1909,17 @@ class StateMachine:
                 # There must be one, or we would not have broken from the loop above
                 raise CoinSelectionError("No coin is larger or equal to the needed fee")
 
-        # Found! Now check if any set of smaller coins is more efficient. We can
-        # afford it as this set is likely pretty small.
+        # Found! Now check if any set of smaller coins is more efficient.
         best_candidate = [c]
         smaller_coins = allocated_coins[:i]
-        for candidate in itertools.chain.from_iterable(
-            itertools.combinations(smaller_coins, r)
-            for r in range(2, len(smaller_coins) + 1)
-        ):
-            cand_value = sum(c.amount for c in candidate)
-            cand_effective_value = cand_value - txin_cost * len(candidate)
-            if cand_effective_value >= needed_fee:
-                if cand_effective_value < effective_value:
-                    best_candidate = candidate
-                    effective_value = cand_effective_value
-                # Edge case: if it results in the very same effective value consider
-                # it best if it reduces the transaction size.
-                elif cand_effective_value == effective_value and len(candidate) < len(
-                    best_candidate
-                ):
-                    best_candidate = candidate
-                    effective_value = cand_effective_value
+        candidate = min_overpayment_selection(
+            [c.amount for c in smaller_coins],
+            txin_cost,
+            needed_fee,
+            (effective_value, len(best_candidate)),
+        )
+        if candidate is not None:
+            best_candidate = [smaller_coins[j] for j in candidate]
         selected_coins += best_candidate
 
         return select_coins(selected_coins)
@@ -1100,7 +1979,7 @@ class StateMachine:
                     vault, needed_fee, new_feerate
                 )
 
-            self.mempool.append(
+            self.mempool.add(
                 CancelTx(
                     height,
                     vault.id,
@@ -0,0 +1,186 @@
+"""Check that the coin pool backends behave the same.
+
+Run from the model directory with `python -m pytest`.
+"""
+
+import math
+import random
+
+from simulation import Simulation
+from statemachine import COIN_POOLS, FeebumpCoin, ProcessingState, Vault, VaultState
+
+
+def coin_key(coin):
+    return (coin.id, coin.amount, coin.processing_state, coin.fan_block)
+
+
+def keys(coins):
+    return [coin_key(c) for c in coins]
+
+
+class Pools:
+    """Apply the same operations to a pool of each backend."""
+
+    def __init__(self):
+        self.pools = {name: backend() for name, backend in COIN_POOLS.items()}
+
+    def call(self, method, *args):
+        """Call {method} on each pool, the arguments that are coins are replaced by
+        the pool's own coin with the same id."""
+        results = {}
+        for name, pool in self.pools.items():
+            coins = {c.id: c for c in pool.list_coins()}
+
+            def own(arg):
+                if isinstance(arg, FeebumpCoin):
+                    return coins[arg.id]
+                if isinstance(arg, list):
+                    return [own(a) for a in arg]
+                return arg
+
+            pool_args = [own(a) for a in args]
+            results[name] = getattr(pool, method)(*pool_args)
+        return results
+
+    def first(self):
+        return next(iter(self.pools.values()))
+
+    def assert_same(self):
+        states = list(ProcessingState)
+        for method, args in [
+            ("balance", ()),
+            ("unallocated_balance", ()),
+            ("n_coins", ()),
+            ("unallocated_coins", ()),
+            ("unallocated_coins", (1_000, 20_000)),
+            ("unallocated_coins", (15_000, math.inf)),
+            ("first_unallocated_coin", (5_000.5, 9_000.5)),
+            ("cf_candidates", (states,)),
+            ("cf_candidates", (states[::-1], 10_000)),
+            ("cf_candidates", ([ProcessingState.CONFIRMED], 30_000)),
+        ]:
+            results = self.call(method, *args)
+            for name, res in results.items():
+                if res is None or isinstance(res, int):
+                    continue
+                results[name] = (
+                    coin_key(res) if isinstance(res, FeebumpCoin) else keys(res)
+                )
+            assert len(set(map(repr, results.values()))) == 1, (method, args, results)
+        for state in ProcessingState:
+            results = self.call("coins_in_state", state)
+            assert len({repr(keys(r)) for r in results.values()}) == 1
+        for coin in self.first().list_coins():
+            results = self.call("is_allocated", coin)
+            assert len(set(results.values())) == 1
+            if results[next(iter(results))]:
+                assert len(set(self.call("coin_allocation", coin).values())) == 1
+
+
+def test_same_operations():
+    rng = random.Random(21)
+    pools = Pools()
+    vaults = [Vault(i, 1_000_000) for i in range(8)]
+    height = 0
+
+    for _ in range(300):
+        height += 1
+        pool = pools.first()
+        op = rng.random()
+        pending = list(pool.coins_in_state(ProcessingState.PENDING))
+        unconfirmed = list(pool.coins_in_state(ProcessingState.UNPROCESSED)) + pending
+        unallocated = pool.unallocated_coins()
+        allocated = [c for c in pool.list_coins() if pool.is_allocated(c)]
+
+        if op < 0.15:
+            pools.call("add_coin", rng.randint(1, 40_000))
+        elif op < 0.3:
+            amounts = [rng.choice([5_000, 7_500, 12_000, 25_000]) for _ in range(10)]
+            pools.call("add_coins", amounts, ProcessingState.PENDING)
+        elif op < 0.4 and unconfirmed != []:
+            pools.call("confirm_coin", rng.choice(unconfirmed), height)
+        elif op < 0.5 and len(pending) >= 3:
+            pools.call("confirm_coins", rng.sample(pending, 3), height)
+        elif op < 0.65 and unallocated != []:
+            vault = rng.choice(vaults)
+            coin = pools.call("first_unallocated_coin", 4_000, 13_000)
+            if coin[next(iter(coin))] is not None:
+                pools.call("allocate_coin", coin[next(iter(coin))], vault)
+            else:
+                pools.call("allocate_coin", rng.choice(unallocated), vault)
+        elif op < 0.7 and allocated != []:
+            pools.call("deallocate_coin", rng.choice(allocated))
+        elif op < 0.75 and len(allocated) >= 2:
+            pools.call("deallocate_coins", rng.sample(allocated, 2))
+        elif op < 0.8 and pool.n_coins() > 0:
+            coin = rng.choice(list(pool.list_coins()))
+            pools.call("remove_coin", coin)
+        elif op < 0.85 and pool.n_coins() >= 3:
+            pools.call("remove_coins", rng.sample(list(pool.list_coins()), 3))
+        elif op < 0.9 and allocated != []:
+            # Re-add a coin spent by a replaced Cancel, as an allocated one
+            coin = rng.choice(allocated)
+            vault_id = pool.coin_allocation(coin)
+            pools.call("remove_coin", coin)
+            pools.call(
+                "add_coin",
+                coin.amount,
+                coin.processing_state,
+                coin.fan_block,
+                vault_id,
+                coin.id,
+            )
+        else:
+            vault = rng.choice(vaults)
+            status = rng.choice(list(VaultState))
+            pools.call("set_vault_status", vault.id, status)
+
+        pools.assert_same()
+
+
+def write_fee_history(path, start_height, end_height):
+    rng = random.Random(1)
+    feerate = 3.0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("block_height,mean_feerate,est_1block,min_feerate\n")
+        for height in range(start_height, end_height):
+            feerate = min(max(feerate * rng.uniform(0.9, 1.1), 1), 30)
+            f.write(f"{height},{feerate:.2f},{feerate * 1.2:.2f},{feerate / 2:.2f}\n")
+
+
+def run_simulation(csv_path, cache_dir, coin_pool):
+    random.seed(21000000)
+    sim = Simulation(
+        7,
+        3,
+        24,
+        csv_path,
+        "CUMMAX95Q90",
+        "85Q1H",
+        1,
+        1,
+        10,
+        2,
+        1008,
+        0.5,
+        0.01,
+        0.001,
+        None,
+        with_balance=True,
+        with_cum_op_cost=True,
+        fee_cache_dir=cache_dir,
+        prng_seed=21000000,
+        coin_pool=coin_pool,
+    )
+    sim.run(350000, 355000)
+    return sim.report()[0]
+
+
+def test_same_simulation(tmp_path):
+    csv_path = str(tmp_path / "fees.csv")
+    write_fee_history(csv_path, 340000, 356000)
+    reports = [
+        run_simulation(csv_path, str(tmp_path / "cache"), coin_pool)
+        for coin_pool in COIN_POOLS
+    ]
+    assert reports[0] == reports[1]
@@ -1,3 +1,5 @@
+import heapq
+
 from utils import (
     TX_OVERHEAD_SIZE,
     P2WPKH_INPUT_SIZE,
@@ -10,6 +12,9 @@ from utils import (
 class Transaction:
     """A Transaction in the mempool relevant for the WT wallet."""
 
+    # The id is set by the Mempool
+    __slots__ = ("broadcast_height", "fee", "size", "id")
+
     def __init__(self, broadcast_height):
         self.broadcast_height = broadcast_height
 
@@ -18,13 +23,15 @@ class Transaction:
 
 
 class ConsolidateFanoutTx(Transaction):
+    __slots__ = ("txins", "txouts")
+
     def __init__(self, broadcast_height, txins, txouts):
         super().__init__(broadcast_height)
         self.txins = txins
         self.txouts = txouts
 
-        input_total = sum([c.amount for c in self.txins])
-        output_total = sum([c.amount for c in self.txouts])
+        input_total = sum(c.amount for c in self.txins)
+        output_total = sum(c.amount for c in self.txouts)
         self.fee = input_total - output_total
 
         self.size = (
@@ -35,6 +42,8 @@ class ConsolidateFanoutTx(Transaction):
 
 
 class CancelTx(Transaction):
+    __slots__ = ("vault_id", "fbcoins")
+
     def __init__(self, broadcast_height, vault_id, size_vb, fbcoins):
         super().__init__(broadcast_height)
         self.vault_id = vault_id
@@ -43,3 +52,88 @@ class CancelTx(Transaction):
         # practical-revault specs
         self.fee = sum(c.amount for c in fbcoins)
         self.fbcoins = fbcoins
+
+
+class Mempool:
+    """The transactions of the WT wallet pending confirmation.
+
+    They are kept by id, in the order they were added. The pending Cancel are
+    also indexed by the height at which their locktime expires.
+    The pending Consolidate-fanout are indexed by their broadcast height, so that
+    we can get the oldest pending transactions without going through all of them.
+    """
+
+    def __init__(self, locktime):
+        self.locktime = locktime
+        # A map from the tx id to the tx
+        self.txs = {}
+        # A counter to generate unique ids for transactions
+        self.tx_id = 0
+        # Heaps of (expiration height, id) of the Cancel and (broadcast height, id)
+        # of the Consolidate-fanout. The entries of the removed transactions are only
+        # dropped once they make it to the top.
+        self.cancel_expirations = []
+        self.cf_broadcasts = []
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __iter__(self):
+        return iter(self.txs.values())
+
+    def add(self, tx):
+        self.tx_id += 1
+        tx.id = self.tx_id
+        self.txs[tx.id] = tx
+        if isinstance(tx, CancelTx):
+            heapq.heappush(
+                self.cancel_expirations, (tx.broadcast_height + self.locktime, tx.id)
+            )
+        else:
+            heapq.heappush(self.cf_broadcasts, (tx.broadcast_height, tx.id))
+
+    def remove(self, tx):
+        del self.txs[tx.id]
+
+    def top(self, heap):
+        while heap != [] and heap[0][1] not in self.txs:
+            heapq.heappop(heap)
+        return self.txs[heap[0][1]] if heap != [] else None
+
+    def oldest_cancel(self):
+        """The pending Cancel tx whose locktime expires first, None if none."""
+        return self.top(self.cancel_expirations)
+
+    def oldest_cf(self):
+        """The Consolidate-fanout tx pending for the longest, None if none."""
+        return self.top(self.cf_broadcasts)
+
+    def next_expiration(self):
+        """The height at which the locktime of a pending Cancel expires first, None
+        if there is no pending Cancel."""
+        tx = self.oldest_cancel()
+        return tx.broadcast_height + self.locktime if tx is not None else None
+
+    def walk(self):
+        """Go through the pending transactions in the order they were added,
+        including the ones added in the meantime.
+
+        FIXME: the transactions used to be kept in a list which was iterated over
+        while removing from it. This mimics it: the transaction right after one
+        removed during the walk is skipped, and only considered next time.
+        """
+        ids, last_id = list(self.txs), self.tx_id
+        i = 0
+        while True:
+            if i >= len(ids):
+                # Go through the transactions added during the walk too
+                ids += [j for j in range(last_id + 1, self.tx_id + 1) if j in self.txs]
+                last_id = self.tx_id
+                if i >= len(ids):
+                    return
+            tx = self.txs.get(ids[i])
+            if tx is not None:
+                yield tx
+                if tx.id not in self.txs:
+                    i += 1
+            i += 1